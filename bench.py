@@ -0,0 +1,314 @@
+"""
+Benchmark harness for MedRefer.
+
+Replays the questions in examples.json through MedReferral against a local
+stand-in for litellm.completion, so the numbers measure the overhead MedRefer
+adds on top of the model rather than the provider itself.
+
+Usage:
+    python bench.py --latency 0.05 --jitter 0.01 --concurrency 16 --output run.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from medrefer import EXAMPLES_PATH, LRUCache, MedReferral, SQLiteCache, _nearest_rank
+
+SCENARIOS = ("sync", "batch", "cached")
+
+
+def load_examples(path=EXAMPLES_PATH):
+    """
+    Returns ``(question, specialist)`` pairs from examples.json.
+    """
+    with open(path) as f:
+        corpus = json.load(f)
+    return [(question, specialist) for specialist, questions in corpus.items() for question in questions]
+
+
+class FakeBackend:
+    """
+    A local stand-in for litellm with configurable latency and jitter.
+
+    Questions found in the labeled examples are answered with their label;
+    anything else is routed to an internist. Packed prompts get one numbered
+    answer line per question. A system prefix seen before is reported as
+    cached prompt tokens, like a provider with prefix caching. Prompts that
+    list specialist codes get a ``{"codes": [...]}`` answer instead.
+    """
+
+    _question_pattern = re.compile(r'^\s*(?:(\d+)\.\s*)?Question:\s*"(.*)"\s*$', re.MULTILINE)
+    _code_pattern = re.compile(r"^(\d+): (.+)$", re.MULTILINE)
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0, examples=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.answers = dict(load_examples() if examples is None else examples)
+        self.calls = 0
+        self._prefixes = set()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def completion(self, **kwargs):
+        time.sleep(self._delay())
+        return self._respond(kwargs)
+
+    async def acompletion(self, **kwargs):
+        await asyncio.sleep(self._delay())
+        return self._respond(kwargs)
+
+    def _delay(self):
+        with self._lock:
+            self.calls += 1
+            jitter = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, self.latency + jitter)
+
+    @staticmethod
+    def _text(content):
+        if isinstance(content, list):
+            return "".join(part.get("text", "") for part in content)
+        return content
+
+    def _cached_tokens(self, messages):
+        if len(messages) < 2 or messages[0]["role"] != "system":
+            return 0
+        prefix = self._text(messages[0]["content"])
+        with self._lock:
+            seen = prefix in self._prefixes
+            self._prefixes.add(prefix)
+        return len(prefix) // 4 if seen else 0
+
+    def _respond(self, kwargs):
+        prompt = self._text(kwargs["messages"][-1]["content"])
+        prompt_chars = sum(len(self._text(message["content"])) for message in kwargs["messages"])
+        matches = self._question_pattern.findall(prompt)
+        # Later matches win, so few-shot examples in the preamble are ignored
+        numbered = {number: question for number, question in matches if number}
+        if numbered:
+            asked = [(number, numbered[number]) for number in sorted(numbered, key=int)]
+        else:
+            asked = matches[-1:]
+
+        system = self._text(kwargs["messages"][0]["content"])
+        codes = {name: int(code) for code, name in self._code_pattern.findall(system)}
+        lines = []
+        for number, question in asked:
+            specialist = self.answers.get(question, "Internal Medicine Doctor (Internist)")
+            if codes and not number:
+                lines.append(json.dumps({"codes": [codes[specialist]]}, separators=(",", ":")))
+            else:
+                lines.append(f"{number + '. ' if number else ''}Specialists: {specialist}")
+        content = "\n".join(lines)
+
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_chars // 4,
+                completion_tokens=len(content) // 4,
+                total_tokens=(prompt_chars + len(content)) // 4,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=self._cached_tokens(kwargs["messages"])),
+            ),
+        )
+
+
+def _percentile(sorted_values, percent):
+    # Nearest rank, like the percentiles in ReferralService.stats() and evaluate.py
+    return _nearest_rank(sorted_values, percent) if sorted_values else 0.0
+
+
+def _summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "items": len(latencies),
+        "elapsed_s": elapsed,
+        "throughput_qps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    }
+
+
+def run_scenario(name, questions, backend, concurrency=8):
+    """
+    Runs one scenario and returns ``(latencies, elapsed)`` in seconds.
+
+    Batch items are timed individually: each latency runs from the start of
+    the batch to that item's completion, so queueing behind the concurrency
+    cap shows up in the tail.
+    """
+    if name == "sync":
+        referral = MedReferral(backend=backend)
+    elif name == "batch":
+        referral = MedReferral(backend=backend)
+        latencies = []
+        start = time.perf_counter()
+        for _ in referral.iter_completed(questions, max_concurrency=concurrency):
+            latencies.append(time.perf_counter() - start)
+        return latencies, time.perf_counter() - start
+    elif name == "cached":
+        referral = MedReferral(backend=backend, cache=LRUCache(max_entries=len(questions)))
+        for question in questions:
+            referral.get_specialist_recommendation(question)
+        # Only the timed pass counts towards llm_calls
+        backend.calls = 0
+    else:
+        raise ValueError(f"Unknown scenario: {name}")
+
+    latencies = []
+    start = time.perf_counter()
+    for question in questions:
+        item_start = time.perf_counter()
+        referral.get_specialist_recommendation(question)
+        latencies.append(time.perf_counter() - item_start)
+    return latencies, time.perf_counter() - start
+
+
+def measure_allocations(name, questions, backend, concurrency=8):
+    """
+    Re-runs a scenario under tracemalloc and reports allocation totals.
+    """
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        run_scenario(name, questions, backend, concurrency)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "alloc_peak_kib": (peak - before) / 1024,
+        "alloc_retained_kib": (current - before) / 1024,
+        "alloc_peak_per_item_bytes": (peak - before) / len(questions),
+    }
+
+
+# Runs in a fresh interpreter: import medrefer, then answer one question from a warm cache
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from medrefer import MedReferral, SQLiteCache
+imported = time.perf_counter()
+result = MedReferral(cache=SQLiteCache(sys.argv[1])).recommend(sys.argv[2])
+answered = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_answer_ms": (answered - start) * 1000,
+    "source": result.source,
+    "litellm_imported": "litellm" in sys.modules,
+}))
+"""
+
+
+def measure_startup(repeat=5):
+    """
+    Times importing medrefer and answering from a warm SQLite cache in fresh interpreters.
+
+    Reports the best of ``repeat`` runs, and whether litellm was imported,
+    which would mean the cache path is paying for the provider SDK again.
+    """
+    question = load_examples()[0][0]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cache.db")
+        cache = SQLiteCache(path)
+        MedReferral(backend=FakeBackend(), cache=cache).recommend(question)
+        cache.close()
+        runs = [
+            json.loads(subprocess.run(
+                [sys.executable, "-c", _STARTUP_SCRIPT, path, question],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).stdout)
+            for _ in range(repeat)
+        ]
+    return {
+        "import_ms": min(run["import_ms"] for run in runs),
+        "first_cached_answer_ms": min(run["first_answer_ms"] for run in runs),
+        "answered_from": runs[0]["source"],
+        "litellm_imported": any(run["litellm_imported"] for run in runs),
+    }
+
+
+def run_benchmark(scenarios=SCENARIOS, latency=0.0, jitter=0.0, concurrency=8, repeat=1,
+                  allocations=True, seed=0, startup=True):
+    """
+    Runs the selected scenarios and returns a JSON-serializable report.
+    """
+    questions = [question for question, _ in load_examples()] * repeat
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "latency_s": latency,
+            "jitter_s": jitter,
+            "concurrency": concurrency,
+            "repeat": repeat,
+            "questions": len(questions),
+        },
+        "scenarios": {},
+    }
+
+    for name in scenarios:
+        backend = FakeBackend(latency, jitter, seed)
+        latencies, elapsed = run_scenario(name, questions, backend, concurrency)
+        result = _summarize(latencies, elapsed)
+        result["llm_calls"] = backend.calls
+        # Subtracting the stand-in's configured latency leaves MedRefer's own cost
+        result["overhead_per_item_ms"] = max(
+            0.0, (elapsed - backend.calls * latency / (concurrency if name == "batch" else 1))
+            / len(questions) * 1000,
+        )
+        if allocations:
+            result.update(measure_allocations(name, questions, FakeBackend(0.0, 0.0, seed), concurrency))
+        report["scenarios"][name] = result
+
+    if startup:
+        report["startup"] = measure_startup()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MedRefer against a mock LLM backend.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform latency jitter in seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="In-flight cap for the batch scenario")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of passes over examples.json")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the latency jitter")
+    parser.add_argument("--no-allocations", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--no-startup", action="store_true", help="Skip the cold-start measurement")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        scenarios=args.scenarios,
+        latency=args.latency,
+        jitter=args.jitter,
+        concurrency=args.concurrency,
+        repeat=args.repeat,
+        allocations=not args.no_allocations,
+        seed=args.seed,
+        startup=not args.no_startup,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
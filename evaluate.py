@@ -0,0 +1,193 @@
+"""
+Accuracy and cost evaluation for MedRefer.
+
+Runs every labeled question in examples.json through MedReferral with a chosen
+model, then reports per-specialist precision and recall, a confusion matrix,
+and the tokens, latency and cost of every item.
+
+Usage:
+    python evaluate.py --model gpt-4o-mini --workers 16 --output eval.json
+    python evaluate.py --model gpt-4o-mini --cassette eval.cassette --record  # then replay offline
+"""
+
+import argparse
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import litellm
+
+from bench import FakeBackend, load_examples
+from medrefer import EXAMPLES_PATH, CassetteBackend, MedReferral, RecommendationStatus, _nearest_rank
+
+NO_SPECIALIST = "(none)"
+
+
+def _cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    try:
+        prompt_cost, completion_cost = litellm.cost_per_token(
+            model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+            cache_read_input_tokens=cached_tokens,
+        )
+        return prompt_cost + completion_cost
+    except Exception:
+        return None
+
+
+def evaluate_item(referral, question, label):
+    """
+    Runs one labeled question and returns its evaluation record.
+    """
+    result = referral.recommend(question)
+    predicted = list(result.specialists)
+    return {
+        "question": question,
+        "label": label,
+        "predicted": predicted,
+        "answer": str(result),
+        "status": result.status.value,
+        "error": result.status is RecommendationStatus.ERROR,
+        "correct": label in predicted,
+        "top1_correct": predicted[:1] == [label],
+        "latency_s": result.latency,
+        "prompt_tokens": result.prompt_tokens,
+        "completion_tokens": result.completion_tokens,
+        "cached_tokens": result.cached_tokens,
+        "cost_usd": _cost(result.model, result.prompt_tokens, result.completion_tokens,
+                          result.cached_tokens),
+    }
+
+
+def score(items, specialists):
+    """
+    Computes per-specialist precision/recall and the confusion matrix.
+
+    Confusion rows are gold labels and columns are predicted specialists; a
+    multi-specialist answer adds one count to every predicted column, and an
+    answer with no valid specialist counts under ``(none)``.
+    """
+    confusion = defaultdict(Counter)
+    predicted_counts = Counter()
+    true_positives = Counter()
+    support = Counter()
+
+    for item in items:
+        support[item["label"]] += 1
+        for specialist in item["predicted"] or [NO_SPECIALIST]:
+            confusion[item["label"]][specialist] += 1
+            predicted_counts[specialist] += 1
+            if specialist == item["label"]:
+                true_positives[specialist] += 1
+
+    per_specialist = {}
+    for specialist in sorted(specialists):
+        predicted = predicted_counts[specialist]
+        gold = support[specialist]
+        precision = true_positives[specialist] / predicted if predicted else 0.0
+        recall = true_positives[specialist] / gold if gold else 0.0
+        per_specialist[specialist] = {
+            "support": gold,
+            "predicted": predicted,
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        }
+
+    return per_specialist, {label: dict(row) for label, row in sorted(confusion.items())}
+
+
+def summarize(items, per_specialist):
+    latencies = sorted(item["latency_s"] for item in items)
+    costs = [item["cost_usd"] for item in items if item["cost_usd"] is not None]
+    scored = [result for result in per_specialist.values() if result["support"]]
+    return {
+        "items": len(items),
+        "errors": sum(item["error"] for item in items),
+        "accuracy": sum(item["correct"] for item in items) / len(items),
+        "top1_accuracy": sum(item["top1_correct"] for item in items) / len(items),
+        "macro_precision": sum(r["precision"] for r in scored) / len(scored),
+        "macro_recall": sum(r["recall"] for r in scored) / len(scored),
+        "prompt_tokens": sum(item["prompt_tokens"] for item in items),
+        "completion_tokens": sum(item["completion_tokens"] for item in items),
+        "cached_tokens": sum(item["cached_tokens"] for item in items),
+        "cost_usd": sum(costs) if costs else None,
+        "p50_latency_s": _nearest_rank(latencies, 50),
+        "p95_latency_s": _nearest_rank(latencies, 95),
+    }
+
+
+def run_evaluation(model="gemini-2.5-flash", workers=8, backend=None, examples_path=EXAMPLES_PATH,
+                   limit=None, output_format="text"):
+    """
+    Evaluates ``model`` over the labeled examples and returns a JSON-serializable report.
+    """
+    examples = load_examples(examples_path)[:limit]
+    referral = MedReferral(backend=backend, model=model, output=output_format)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        items = list(executor.map(lambda example: evaluate_item(referral, *example), examples))
+    elapsed = time.perf_counter() - start
+
+    per_specialist, confusion = score(items, referral.medical_specialists)
+    summary = summarize(items, per_specialist)
+    summary["elapsed_s"] = elapsed
+    return {
+        "model": model,
+        "output_format": output_format,
+        "workers": workers,
+        "summary": summary,
+        "per_specialist": per_specialist,
+        "confusion": confusion,
+        "items": items,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate MedRefer routing accuracy and cost.")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="LiteLLM model name")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel requests")
+    parser.add_argument("--examples", default=EXAMPLES_PATH, help="Labeled examples JSON file")
+    parser.add_argument("--limit", type=int, help="Only evaluate the first N examples")
+    parser.add_argument("--format", choices=("text", "json"), default="text", dest="output_format",
+                        help="Answer format to request from the model")
+    parser.add_argument("--fake", action="store_true", help="Use the mock backend (dry run)")
+    parser.add_argument("--cassette", help="Replay model answers from this cassette file")
+    parser.add_argument("--record", action="store_true", help="Record answers to --cassette instead")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.record and not args.cassette:
+        parser.error("--record requires --cassette")
+
+    backend = FakeBackend(examples=load_examples(args.examples)) if args.fake else None
+    if args.cassette:
+        backend = CassetteBackend(args.cassette, "record" if args.record else "replay", backend)
+    report = run_evaluation(
+        model=args.model,
+        workers=args.workers,
+        backend=backend,
+        examples_path=args.examples,
+        limit=args.limit,
+        output_format=args.output_format,
+    )
+
+    summary = report["summary"]
+    print(
+        f"{report['model']}: accuracy {summary['accuracy']:.1%} "
+        f"(top-1 {summary['top1_accuracy']:.1%}), {summary['errors']} errors, "
+        f"{summary['prompt_tokens'] + summary['completion_tokens']} tokens, "
+        f"p50 {summary['p50_latency_s'] * 1000:.0f} ms",
+        file=sys.stderr,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
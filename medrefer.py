@@ -1,123 +1,3365 @@
-import litellm
+import argparse
+import contextlib
+import csv
+import enum
+import hashlib
+import importlib
+import itertools
+import json
+import math
+import mmap
 import os
+import queue
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples.json")
+
+
+class _LazyModule:
+    """
+    Stands in for a heavy module and imports it on first attribute access.
+
+    Attributes are looked up on the real module every time, so patching
+    e.g. ``litellm.completion`` keeps working.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = sys.modules.get(self._name)
+        if module is None:
+            module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+# litellm pulls in a very large dependency tree, so it is only imported for the
+# first real LLM call or token count; cache and classifier answers never pay for it.
+litellm = _LazyModule("litellm")
+# numpy is only needed for the local classifier and the semantic cache
+np = _LazyModule("numpy")
+# Only needed by AsyncMedReferral, the HTTP service and Retry-After dates respectively
+asyncio = _LazyModule("asyncio")
+http_server = _LazyModule("http.server")
+email_utils = _LazyModule("email.utils")
+
+
+def _require_numpy(feature):
+    """
+    Raises a helpful ImportError when numpy, which ``feature`` needs, is not installed.
+    """
+    try:
+        importlib.import_module("numpy")
+    except ImportError:
+        raise ImportError(f"{feature} requires numpy (pip install numpy)") from None
+
+
+def _nearest_rank(sorted_values, percent):
+    """
+    Returns the nearest-rank ``percent`` percentile of a non-empty sorted list.
+    """
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+def normalize_question(question):
+    """
+    Normalizes a question for cache lookups: case-folded with whitespace collapsed.
+    """
+    return " ".join(question.split()).casefold()
+
+
+class ResponseCache:
+    """
+    Base class for recommendation caches.
+
+    Subclasses implement ``_get`` and ``_set``; hit and miss counters are kept here
+    so every backend reports them the same way. ``ttl`` is in seconds, or None for
+    entries that never expire. Caches are shared by every thread using a
+    MedReferral, so subclasses must make ``_get`` and ``_set`` thread-safe.
+    """
+
+    def __init__(self, max_entries=10000, ttl=None):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        self._set(key, value, expires_at)
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "size": len(self),
+        }
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, expires_at):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class LRUCache(ResponseCache):
+    """
+    An in-memory, thread-safe LRU cache with optional TTL.
+    """
+
+    def __init__(self, max_entries=10000, ttl=None):
+        super().__init__(max_entries, ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache(ResponseCache):
+    """
+    A persistent cache stored in a SQLite database, evicting least recently used entries.
+
+    Hits do not write to disk: access times are buffered in memory and
+    written with the next ``set`` (or ``close``), just before eviction needs
+    them. The database runs in WAL mode with ``synchronous=NORMAL``, so a
+    ``set`` does not wait for an fsync either.
+    """
+
+    _max_buffered_accesses = 1000
+
+    def __init__(self, path, max_entries=100000, ttl=None):
+        super().__init__(max_entries, ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # key -> last hit time, not yet written to accessed_at
+        self._accessed = {}
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+            )
+
+    def _get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            now = time.time()
+            if expires_at is not None and expires_at <= now:
+                with self._conn:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._accessed.pop(key, None)
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= self._max_buffered_accesses:
+                with self._conn:
+                    self._flush_accesses()
+            return value
+
+    def _flush_accesses(self):
+        # Callers hold the lock and a transaction
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def _set(self, key, value, expires_at):
+        with self._lock, self._conn:
+            self._flush_accesses()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time()),
+            )
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            with self._conn:
+                self._flush_accesses()
+            self._conn.close()
+
+
+class SemanticCache:
+    """
+    A near-duplicate cache that matches questions by meaning-bearing words rather than exact text.
+
+    Questions are embedded locally as signed, hashed character n-grams of their
+    content words, with stopwords dropped and common inflections stripped, so
+    reordered and reworded questions land close together without any network
+    call. Lookups are a cosine nearest-neighbour search over a fixed-size
+    float32 matrix, optionally memory-mapped from ``path``. Once the matrix is
+    full, new entries overwrite expired or least recently used slots. Entries
+    are partitioned by ``namespace``, so answers are only shared between
+    requests with the same model and prompt, and by the body parts a question
+    names, the patient it describes (a baby, a child, a pregnant or elderly
+    patient) and whether it contains a negation, so "left eye" never matches
+    "left ear", "my baby has chest pain" never matches "I have chest pain" and
+    "no chest pain" never matches "chest pain".
+
+    The embedding is lexical: it catches reordering, punctuation and
+    inflection, not synonyms. "my chest hurts when I walk" and "chest pain
+    while walking" score about 0.73, and no threshold that low is safe, so
+    such paraphrases go to the LLM.
+    """
+
+    _token_pattern = re.compile(r"[a-z0-9]+")
+    _stopwords = frozenset(
+        "a an and am are as at be can could do does for from have has i if in is it "
+        "me my of on or should the to was what when which while who whom will with "
+        "would you".split()
+    )
+    _suffixes = ("ing", "es", "ed", "s")
+    _negations = frozenset(
+        "no not never without none nor cannot don doesn didn isn aren wasn haven hasn".split()
+    )
+    # Stored as written; compared after the same normalization as every other word
+    _body_parts = (
+        "head scalp face forehead eye eyelid ear nose sinus mouth lip tongue gum tooth teeth jaw "
+        "throat neck shoulder arm elbow wrist hand finger thumb nail chest breast heart lung rib "
+        "back spine stomach abdomen belly liver kidney bladder bowel colon rectum anus pelvis groin "
+        "hip thigh leg knee shin calf ankle foot feet heel toe skin hair brain bone joint muscle "
+        "blood vein artery thyroid prostate testicle penis vagina uterus ovary"
+    ).split()
+    # Words about who the patient is; these change the specialist as much as the symptom
+    _populations = (
+        "baby babies infant newborn toddler child children kid son daughter boy girl teen teenager "
+        "adolescent pediatric pregnant pregnancy fetus elderly senior grandmother grandfather grandma grandpa"
+    ).split()
+
+    def __init__(self, path=None, max_entries=10000, threshold=0.85, n_features=1024, ttl=None):
+        _require_numpy("SemanticCache")
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.path = path
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.n_features = n_features
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._body_part_words = frozenset(self._words(" ".join(self._body_parts)))
+        self._population_words = frozenset(self._words(" ".join(self._populations)))
+
+        shape = (max_entries, n_features)
+        if path is None:
+            self._vectors = np.zeros(shape, dtype=np.float32)
+        else:
+            exists = os.path.exists(path)
+            if exists and os.path.getsize(path) != max_entries * n_features * 4:
+                raise ValueError(f"{path} does not hold a {max_entries}x{n_features} index")
+            self._vectors = np.memmap(path, dtype=np.float32, mode="r+" if exists else "w+", shape=shape)
+        self._namespaces = np.zeros(max_entries, dtype=np.int64)
+        # Logical access clock per slot; -inf marks an empty slot
+        self._accessed = np.full(max_entries, -np.inf)
+        self._expires = np.full(max_entries, np.inf)
+        self._values = [None] * max_entries
+        self._used = 0
+        self._clock = 0
+        if path is not None and os.path.exists(self._meta_path):
+            self._load_meta()
+
+    @property
+    def _meta_path(self):
+        return self.path + ".meta.json"
+
+    @classmethod
+    def embed(cls, question, n_features=1024):
+        """
+        Returns the L2-normalized embedding of ``question``, or a zero vector if it has no content words.
+        """
+        vector = np.zeros(n_features, dtype=np.float32)
+        for word in cls._words(question):
+            word = f"<{word}>"
+            for n in (3, 4, 5):
+                for i in range(len(word) - n + 1):
+                    digest = zlib.crc32(word[i:i + n].encode())
+                    # The top hash bit picks the sign so collisions tend to cancel out
+                    vector[digest % n_features] += -1.0 if digest & 0x80000000 else 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @classmethod
+    def _words(cls, question):
+        """
+        Returns the normalized content words of ``question``: stopwords dropped, endings stripped.
+        """
+        words = []
+        for word in cls._token_pattern.findall(question.lower()):
+            if word in cls._stopwords:
+                continue
+            for suffix in cls._suffixes:
+                if len(word) > len(suffix) + 2 and word.endswith(suffix):
+                    word = word[:-len(suffix)]
+                    break
+            words.append(word)
+        return words
+
+    def _guard_key(self, question):
+        """
+        Returns the body parts, patient words and negation in ``question``; a match must share all three.
+        """
+        words = set(self._words(question))
+        parts = sorted(words & self._body_part_words)
+        population = sorted(words & self._population_words)
+        negated = any(word in self._negations for word in words)
+        return f"{' '.join(parts)}|{' '.join(population)}|{'not' if negated else ''}"
+
+    def get(self, question, namespace=""):
+        """
+        Returns the value stored for the most similar question in ``namespace``, or None.
+        """
+        vector = self.embed(question, self.n_features)
+        with self._lock:
+            slot, similarity = self._nearest(vector, self._namespace_id(namespace, question))
+            if slot is None or similarity < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._accessed[slot] = self._clock
+            return self._values[slot]
+
+    def set(self, question, value, namespace=""):
+        """
+        Stores ``value`` for ``question``, replacing a near-identical entry if there is one.
+        """
+        vector = self.embed(question, self.n_features)
+        if not vector.any():
+            return
+        namespace_id = self._namespace_id(namespace, question)
+        with self._lock:
+            slot, similarity = self._nearest(vector, namespace_id)
+            if slot is None or similarity < 0.999:
+                # Empty and expired slots sort first, then the least recently used one
+                now = time.time()
+                candidates = self._accessed[:min(self._used + 1, self.max_entries)]
+                slot = int(np.argmin(np.where(self._expires[:len(candidates)] <= now, -np.inf, candidates)))
+                self._used = max(self._used, slot + 1)
+            self._clock += 1
+            self._vectors[slot] = vector
+            self._namespaces[slot] = namespace_id
+            self._accessed[slot] = self._clock
+            self._expires[slot] = np.inf if self.ttl is None else time.time() + self.ttl
+            self._values[slot] = value
+
+    def _nearest(self, vector, namespace_id):
+        if not self._used or not vector.any():
+            return None, 0.0
+        similarities = self._vectors[:self._used] @ vector
+        live = ((self._namespaces[:self._used] == namespace_id)
+                & (self._accessed[:self._used] > -np.inf)
+                & (self._expires[:self._used] > time.time()))
+        similarities = np.where(live, similarities, -1.0)
+        slot = int(np.argmax(similarities))
+        if similarities[slot] < 0:
+            return None, 0.0
+        return slot, float(similarities[slot])
+
+    def _namespace_id(self, namespace, question):
+        # Folds the guard words into the partition, so only compatible entries are searched
+        key = f"{namespace}\0{self._guard_key(question)}"
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "little", signed=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self),
+        }
+
+    def __len__(self):
+        with self._lock:
+            return int(np.count_nonzero(self._accessed[:self._used] > -np.inf))
+
+    def flush(self):
+        """
+        Writes the memory-mapped vectors and the entry metadata beside them to disk.
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            self._vectors.flush()
+            slots = [slot for slot in range(self._used) if self._values[slot] is not None]
+            meta = {
+                "clock": self._clock,
+                "entries": [
+                    [slot, int(self._namespaces[slot]), float(self._accessed[slot]),
+                     None if np.isinf(self._expires[slot]) else float(self._expires[slot]),
+                     self._values[slot]]
+                    for slot in slots
+                ],
+            }
+            with open(self._meta_path + ".tmp", "w") as f:
+                json.dump(meta, f)
+            os.replace(self._meta_path + ".tmp", self._meta_path)
+
+    def close(self):
+        self.flush()
+
+    def _load_meta(self):
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        self._clock = meta["clock"]
+        for slot, namespace_id, accessed, expires_at, value in meta["entries"]:
+            if slot >= self.max_entries:
+                continue
+            self._namespaces[slot] = namespace_id
+            self._accessed[slot] = accessed
+            self._expires[slot] = np.inf if expires_at is None else expires_at
+            self._values[slot] = value
+            self._used = max(self._used, slot + 1)
+
+
+class SpecialistClassifier:
+    """
+    A local nearest-neighbour classifier over labeled example questions.
+
+    Questions are embedded as L2-normalized TF-IDF vectors of hashed word unigrams
+    and bigrams, and scored by cosine similarity against every labeled example.
+    The confidence of a prediction is the similarity of the closest example, so
+    only near-paraphrases of known questions clear a high threshold.
+    """
+
+    _token_pattern = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, vectors, labels, idf):
+        _require_numpy("SpecialistClassifier")
+        self.vectors = vectors
+        self.labels = labels
+        self.idf = idf
+
+    @classmethod
+    def from_examples(cls, path=EXAMPLES_PATH, extra=None, n_features=4096):
+        """
+        Builds a classifier from ``examples.json`` plus an optional extra corpus.
+
+        ``extra`` maps specialist names to lists of example questions, in the
+        same shape as ``examples.json``.
+        """
+        _require_numpy("SpecialistClassifier")
+        with open(path) as f:
+            corpus = json.load(f)
+        for specialist, questions in (extra or {}).items():
+            corpus.setdefault(specialist, []).extend(questions)
+
+        unknown = set(corpus) - MedReferral.medical_specialists
+        if unknown:
+            raise ValueError(f"Unknown specialists in corpus: {', '.join(sorted(unknown))}")
+
+        labels = []
+        counts = np.zeros((sum(len(q) for q in corpus.values()), n_features), dtype=np.float32)
+        for specialist, questions in corpus.items():
+            for question in questions:
+                counts[len(labels)] = cls._hash_counts(question, n_features)
+                labels.append(specialist)
+
+        document_frequency = np.count_nonzero(counts, axis=0)
+        idf = np.log((1 + len(labels)) / (1 + document_frequency)).astype(np.float32) + 1
+        vectors = cls._normalize(counts * idf)
+        return cls(vectors, np.array(labels), idf)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a classifier index saved with ``save``.
+        """
+        _require_numpy("SpecialistClassifier")
+        with np.load(path) as data:
+            return cls(data["vectors"], data["labels"], data["idf"])
+
+    def save(self, path):
+        """
+        Saves the index as a compressed ``.npz`` artifact for fast loading.
+        """
+        np.savez_compressed(path, vectors=self.vectors, labels=self.labels, idf=self.idf)
+
+    def predict(self, question):
+        """
+        Returns a ``(specialist, confidence)`` pair for the closest labeled example.
+        """
+        vector = self._hash_counts(question, len(self.idf)) * self.idf
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None, 0.0
+        similarities = self.vectors @ (vector / norm)
+        best = int(np.argmax(similarities))
+        return str(self.labels[best]), float(similarities[best])
+
+    @classmethod
+    def _hash_counts(cls, text, n_features):
+        tokens = cls._token_pattern.findall(text.lower())
+        grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        counts = np.zeros(n_features, dtype=np.float32)
+        for gram in grams:
+            counts[zlib.crc32(gram.encode()) % n_features] += 1
+        return counts
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+
+class SpecialistLineScanner:
+    """
+    Incrementally scans streamed text for a complete "Specialists:" line.
+
+    Uses the same pattern as the non-streaming parser: the line is complete
+    once some content after the label is followed by a newline.
+    """
+
+    _label = re.compile(r"Specialists?:")
+    _line_end = re.compile(r"\s*\S[^\n]*\n")
+
+    def __init__(self):
+        self.text = ""
+        self._search_from = 0
+        self._label_end = None
+
+    def feed(self, text):
+        """
+        Appends streamed text and returns True once the specialists line has ended.
+        """
+        if not text:
+            return False
+        self.text += text
+        if self._label_end is None:
+            # Only rescan the tail that could still contain the start of the label
+            label = self._label.search(self.text, self._search_from)
+            if label is None:
+                self._search_from = max(0, len(self.text) - len("Specialists:"))
+                return False
+            # Names such as "Infectious Disease Specialist" must not move the search past the label
+            self._label_end = label.end()
+        return self._line_end.match(self.text, self._label_end) is not None
+
+
+def _chunk_text(chunk):
+    choices = getattr(chunk, "choices", None)
+    if not choices:
+        return ""
+    return getattr(choices[0].delta, "content", None) or ""
+
+
+def _close_stream(stream):
+    """
+    Closes a streamed response so the provider stops generating tokens.
+    """
+    close = getattr(stream, "close", None)
+    if close is None:
+        # litellm's CustomStreamWrapper only exposes the underlying stream
+        close = getattr(getattr(stream, "completion_stream", None), "close", None)
+    if close is not None:
+        close()
+
+
+# Common alternative names, spellings and abbreviations for each specialist.
+# An alias may stand for several specialists (e.g. "OB/GYN").
+SPECIALIST_ALIASES = {
+    "allergy specialist": ("Allergist",),
+    "allergy doctor": ("Allergist",),
+    "anesthetist": ("Anesthesiologist",),
+    "anaesthetist": ("Anesthesiologist",),
+    "anaesthesiologist": ("Anesthesiologist",),
+    "heart specialist": ("Cardiologist",),
+    "heart surgeon": ("Cardiothoracic Surgeon",),
+    "cardiac surgeon": ("Cardiothoracic Surgeon",),
+    "thoracic surgeon": ("Cardiothoracic Surgeon",),
+    "proctologist": ("Colorectal Surgeon",),
+    "child psychiatrist": ("Child and Adolescent Psychiatrist",),
+    "adolescent psychiatrist": ("Child and Adolescent Psychiatrist",),
+    "skin specialist": ("Dermatologist",),
+    "gi specialist": ("Gastroenterologist",),
+    "geriatric medicine specialist": ("Geriatrician",),
+    "geropsychiatrist": ("Geriatric Psychiatrist",),
+    "gynaecologist": ("Gynecologist",),
+    "ob/gyn": ("Obstetrician", "Gynecologist"),
+    "obgyn": ("Obstetrician", "Gynecologist"),
+    "haematologist": ("Hematologist",),
+    "infectious diseases specialist": ("Infectious Disease Specialist",),
+    "infectious disease doctor": ("Infectious Disease Specialist",),
+    "internist": ("Internal Medicine Doctor (Internist)",),
+    "internal medicine doctor": ("Internal Medicine Doctor (Internist)",),
+    "internal medicine physician": ("Internal Medicine Doctor (Internist)",),
+    "internal medicine": ("Internal Medicine Doctor (Internist)",),
+    "perinatologist": ("Maternal-Fetal Medicine Specialist",),
+    "maternal fetal medicine": ("Maternal-Fetal Medicine Specialist",),
+    "kidney specialist": ("Nephrologist",),
+    "neurological surgeon": ("Neurosurgeon",),
+    "brain surgeon": ("Neurosurgeon",),
+    "nuclear medicine physician": ("Nuclear Medicine Specialist",),
+    "occupational health physician": ("Occupational Medicine Specialist",),
+    "occupational medicine physician": ("Occupational Medicine Specialist",),
+    "cancer specialist": ("Oncologist",),
+    "medical oncologist": ("Oncologist",),
+    "orthopaedic surgeon": ("Orthopedic Surgeon",),
+    "orthopedist": ("Orthopedic Surgeon",),
+    "orthopaedist": ("Orthopedic Surgeon",),
+    "orthopedic specialist": ("Orthopedic Surgeon",),
+    "eye specialist": ("Ophthalmologist",),
+    "eye doctor": ("Ophthalmologist",),
+    "otolaryngologist": ("Otolaryngologist (ENT Specialist)",),
+    "ent": ("Otolaryngologist (ENT Specialist)",),
+    "ent specialist": ("Otolaryngologist (ENT Specialist)",),
+    "ent doctor": ("Otolaryngologist (ENT Specialist)",),
+    "ear nose and throat specialist": ("Otolaryngologist (ENT Specialist)",),
+    "ear nose and throat doctor": ("Otolaryngologist (ENT Specialist)",),
+    "paediatrician": ("Pediatrician",),
+    "lung specialist": ("Pulmonologist",),
+    "pulmonary specialist": ("Pulmonologist",),
+    "paediatric surgeon": ("Pediatric Surgeon",),
+    "reconstructive surgeon": ("Plastic Surgeon",),
+    "cosmetic surgeon": ("Plastic Surgeon",),
+    "physiatrist": ("Physical Medicine & Rehabilitation (PM&R) Specialist",),
+    "pm&r": ("Physical Medicine & Rehabilitation (PM&R) Specialist",),
+    "pm&r specialist": ("Physical Medicine & Rehabilitation (PM&R) Specialist",),
+    "physical medicine and rehabilitation": ("Physical Medicine & Rehabilitation (PM&R) Specialist",),
+    "physical medicine and rehabilitation specialist": ("Physical Medicine & Rehabilitation (PM&R) Specialist",),
+    "rehabilitation specialist": ("Physical Medicine & Rehabilitation (PM&R) Specialist",),
+    "pain specialist": ("Pain Management Specialist",),
+    "pain medicine specialist": ("Pain Management Specialist",),
+    "sports medicine specialist": ("Sports Medicine Doctor",),
+    "sports medicine physician": ("Sports Medicine Doctor",),
+    "sleep specialist": ("Sleep Medicine Specialist",),
+}
+
+# ``(code, display name)`` for every specialist; the position is its stable ID
+# and bit in a result mask. Append new specialists and never reorder, so stored
+# masks and JSON answer codes keep their meaning.
+SPECIALISTS = (
+    ("ALG", "Allergist"),
+    ("ANES", "Anesthesiologist"),
+    ("CARD", "Cardiologist"),
+    ("CTS", "Cardiothoracic Surgeon"),
+    ("CRS", "Colorectal Surgeon"),
+    ("CAP", "Child and Adolescent Psychiatrist"),
+    ("DERM", "Dermatologist"),
+    ("ENDO", "Endocrinologist"),
+    ("FPSY", "Forensic Psychiatrist"),
+    ("GI", "Gastroenterologist"),
+    ("GS", "General Surgeon"),
+    ("GER", "Geriatrician"),
+    ("GPSY", "Geriatric Psychiatrist"),
+    ("GYN", "Gynecologist"),
+    ("HEME", "Hematologist"),
+    ("ID", "Infectious Disease Specialist"),
+    ("IM", "Internal Medicine Doctor (Internist)"),
+    ("IMM", "Immunologist"),
+    ("MFM", "Maternal-Fetal Medicine Specialist"),
+    ("NEPH", "Nephrologist"),
+    ("NEUR", "Neurologist"),
+    ("NSGY", "Neurosurgeon"),
+    ("NEO", "Neonatologist"),
+    ("NM", "Nuclear Medicine Specialist"),
+    ("OB", "Obstetrician"),
+    ("OCC", "Occupational Medicine Specialist"),
+    ("ONC", "Oncologist"),
+    ("ORTH", "Orthopedic Surgeon"),
+    ("OPH", "Ophthalmologist"),
+    ("ENT", "Otolaryngologist (ENT Specialist)"),
+    ("PED", "Pediatrician"),
+    ("PATH", "Pathologist"),
+    ("PULM", "Pulmonologist"),
+    ("PSGY", "Pediatric Surgeon"),
+    ("PLS", "Plastic Surgeon"),
+    ("PMR", "Physical Medicine & Rehabilitation (PM&R) Specialist"),
+    ("PAIN", "Pain Management Specialist"),
+    ("PSY", "Psychiatrist"),
+    ("RHEUM", "Rheumatologist"),
+    ("RAD", "Radiologist"),
+    ("SPORT", "Sports Medicine Doctor"),
+    ("SLEEP", "Sleep Medicine Specialist"),
+    ("TRS", "Trauma Surgeon"),
+    ("TXS", "Transplant Surgeon"),
+    ("URO", "Urologist"),
+)
+
+
+class SpecialistRegistry:
+    """
+    Stable integer IDs, short codes, display names and aliases for every specialist.
+
+    A set of specialists is encoded as an int with bit ``id`` set for each
+    member, so a result fits in one uint64. ``counts`` and ``co_referrals``
+    aggregate NumPy arrays of such masks in fixed-size chunks, which keeps
+    analytics over millions of results vectorized and memory-bounded.
+    """
+
+    def __init__(self, specialists=SPECIALISTS, aliases=None):
+        if len(specialists) > 64:
+            raise ValueError("A 64-bit mask holds at most 64 specialists")
+        self.codes = tuple(code for code, _ in specialists)
+        self.names = tuple(name for _, name in specialists)
+        if len(set(self.codes)) != len(self.codes) or len(set(self.names)) != len(self.names):
+            raise ValueError("Specialist codes and names must be unique")
+
+        # Case-folded names and codes to IDs; ``_keys`` adds aliases, which may stand for several
+        self._ids = {}
+        for id_, (code, name) in enumerate(specialists):
+            self._ids[code.casefold()] = id_
+            self._ids[name.casefold()] = id_
+        self._keys = {key: (id_,) for key, id_ in self._ids.items()}
+        self.aliases = {}
+        for alias, targets in (aliases or {}).items():
+            self.aliases[alias] = tuple(self.id(target) for target in targets)
+            self._keys.setdefault(alias.casefold(), self.aliases[alias])
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, name):
+        """
+        Returns the ID of a specialist given its display name or code.
+        """
+        try:
+            return self._ids[name.casefold()]
+        except KeyError:
+            raise KeyError(f"Unknown specialist: {name}") from None
+
+    def ids(self, key):
+        """
+        Returns the IDs a display name, code or alias stands for, or () if unknown.
+        """
+        return self._keys.get(key.casefold(), ())
+
+    def encode(self, specialists):
+        """
+        Encodes display names, codes or aliases as a bit mask; unknown entries raise KeyError.
+        """
+        mask = 0
+        for specialist in specialists:
+            ids = self.ids(specialist)
+            if not ids:
+                raise KeyError(f"Unknown specialist: {specialist}")
+            for id_ in ids:
+                mask |= 1 << id_
+        return mask
+
+    def decode(self, mask):
+        """
+        Returns the display names in ``mask``, in ID order.
+        """
+        mask = int(mask)
+        if mask >> len(self.names):
+            raise ValueError(f"Mask {mask:#x} has bits beyond the {len(self.names)} known specialists")
+        return tuple(name for id_, name in enumerate(self.names) if mask >> id_ & 1)
+
+    def masks(self, results):
+        """
+        Encodes Recommendations or iterables of specialists as a uint64 NumPy array.
+        """
+        _require_numpy("SpecialistRegistry.masks")
+        return np.fromiter(
+            (self.encode(getattr(result, "specialists", result)) for result in results), dtype=np.uint64,
+        )
+
+    def _bit_chunks(self, masks, chunk_size):
+        # One row of 0/1 bytes per mask, columns in ID order
+        masks = np.ascontiguousarray(masks, dtype="<u8").reshape(-1)
+        for start in range(0, len(masks), chunk_size):
+            chunk = masks[start:start + chunk_size].view(np.uint8).reshape(-1, 8)
+            yield np.unpackbits(chunk, axis=1, bitorder="little")[:, :len(self.names)]
+
+    def counts(self, masks, chunk_size=65536):
+        """
+        Returns how many masks include each specialist, as an int64 array indexed by ID.
+        """
+        _require_numpy("SpecialistRegistry.counts")
+        total = np.zeros(len(self.names), dtype=np.int64)
+        for bits in self._bit_chunks(masks, chunk_size):
+            total += bits.sum(axis=0, dtype=np.int64)
+        return total
+
+    def co_referrals(self, masks, chunk_size=65536):
+        """
+        Returns the co-referral matrix: entry ``[i, j]`` counts masks containing both i and j.
+
+        The diagonal equals ``counts``. Chunks are multiplied in float32, which
+        is exact while ``chunk_size`` stays below 2**24.
+        """
+        _require_numpy("SpecialistRegistry.co_referrals")
+        if chunk_size >= 1 << 24:
+            raise ValueError("chunk_size must be below 2**24")
+        total = np.zeros((len(self.names), len(self.names)), dtype=np.int64)
+        for bits in self._bit_chunks(masks, chunk_size):
+            bits = bits.astype(np.float32)
+            total += (bits.T @ bits).astype(np.int64)
+        return total
+
+
+SPECIALIST_REGISTRY = SpecialistRegistry(SPECIALISTS, SPECIALIST_ALIASES)
+
+
+class SpecialistMatcher:
+    """
+    Maps every specialist mention in free text to its canonical name.
+
+    Canonical names and aliases are normalized (case-folded, punctuation removed,
+    plurals collapsed) into a word-level trie that is built once. ``find`` scans
+    the text in a single left-to-right pass, taking the longest match at each
+    position, so cost stays linear in the length of the response. With
+    ``max_edits`` > 0, words of at least ``min_fuzzy_length`` characters that
+    are not in the vocabulary are corrected to the unique vocabulary word within
+    that edit distance, which recovers typos such as "Dermatolgist". This is
+    off by default: real specialty names one edit apart would be misrouted
+    ("Hepatologist" to "Hematologist").
+    """
+
+    _word_pattern = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, specialists, aliases=None, max_edits=0, min_fuzzy_length=6):
+        self.max_edits = max_edits
+        self.min_fuzzy_length = min_fuzzy_length
+        self._trie = {}
+        self._vocabulary = set()
+        self._corrections = {}
+
+        for specialist in specialists:
+            self._add(specialist, (specialist,))
+        for alias, targets in (aliases or {}).items():
+            unknown = set(targets) - set(specialists)
+            if unknown:
+                raise ValueError(f"Alias {alias!r} targets unknown specialists: {', '.join(sorted(unknown))}")
+            self._add(alias, tuple(targets))
+
+    @classmethod
+    def normalize(cls, text):
+        """
+        Splits text into normalized words: lowercase, "&" spelled out, plurals collapsed.
+        """
+        words = cls._word_pattern.findall(text.lower().replace("&", " and "))
+        return [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+                for w in words]
+
+    def _add(self, name, targets):
+        node = self._trie
+        for word in self.normalize(name):
+            self._vocabulary.add(word)
+            node = node.setdefault(word, {})
+        # Canonical names are added first, so they win over identical aliases
+        node.setdefault(None, targets)
+
+    def find(self, text):
+        """
+        Returns the canonical specialists mentioned in ``text``, in order of first mention.
+        """
+        words = [self._correct(word) for word in self.normalize(text)]
+        found = []
+        position = 0
+        while position < len(words):
+            node = self._trie
+            match, match_end = None, position
+            for end in range(position, len(words)):
+                node = node.get(words[end])
+                if node is None:
+                    break
+                if None in node:
+                    match, match_end = node[None], end + 1
+            if match is None:
+                position += 1
+                continue
+            for specialist in match:
+                if specialist not in found:
+                    found.append(specialist)
+            position = match_end
+        return found
+
+    def _correct(self, word):
+        if (not self.max_edits or word in self._vocabulary
+                or len(word) < self.min_fuzzy_length):
+            return word
+        corrected = self._corrections.get(word)
+        if corrected is None:
+            candidates = [v for v in self._vocabulary
+                          if len(v) >= self.min_fuzzy_length
+                          and _within_edits(word, v, self.max_edits)]
+            corrected = candidates[0] if len(candidates) == 1 else word
+            if len(self._corrections) > 10000:
+                self._corrections.clear()
+            self._corrections[word] = corrected
+        return corrected
+
+
+def _within_edits(a, b, max_edits):
+    """
+    Returns True if the Levenshtein distance between ``a`` and ``b`` is at most ``max_edits``.
+    """
+    if abs(len(a) - len(b)) > max_edits:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_edits:
+            return False
+        previous = current
+    return previous[-1] <= max_edits
+
+
+def _chunked(iterable, size):
+    """
+    Lazily splits ``iterable`` into lists of at most ``size`` items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the provider while the circuit breaker is open.
+    """
+
+
+class RetryPolicy:
+    """
+    Decides which provider errors are retried and how long to wait between attempts.
+
+    Delays grow exponentially from ``base_delay`` up to ``max_delay`` with full
+    jitter. When the provider sends ``Retry-After``, that delay is used instead;
+    if it exceeds ``max_delay`` the error is raised rather than retried.
+    """
+
+    retryable_status_codes = frozenset([408, 409, 425, 429, 500, 502, 503, 504])
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=20.0, seed=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.gave_up = 0
+
+    def is_retryable(self, error):
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        return getattr(error, "status_code", None) in self.retryable_status_codes
+
+    def delay(self, attempt, error):
+        """
+        Returns the seconds to wait before retry number ``attempt`` (1-based), or None to give up.
+        """
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        with self._lock:
+            return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def record(self, retried, error):
+        with self._lock:
+            if retried:
+                self.retries += 1
+            elif self.is_retryable(error):
+                self.gave_up += 1
+
+    def stats(self):
+        return {"retries": self.retries, "gave_up": self.gave_up}
+
+
+def _retry_after(error):
+    """
+    Returns the ``Retry-After`` delay in seconds carried by a provider error, if any.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        headers = getattr(error, "litellm_response_headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email_utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    A thread-safe client-side rate limiter allowing ``rate`` requests per second
+    with bursts of up to ``capacity`` requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+
+    def _reserve(self):
+        """
+        Takes one token, going into debt if necessary, and returns how long to wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            self.acquired += 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            if wait:
+                self.throttled += 1
+                self.wait_time += wait
+            return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        return {"acquired": self.acquired, "throttled": self.throttled, "wait_time": self.wait_time}
+
+
+class CircuitBreaker:
+    """
+    Fails fast while the provider is down.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and calls
+    raise CircuitOpenError for ``reset_timeout`` seconds. Then a single trial
+    call is let through: success closes the circuit, failure reopens it.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError("Provider circuit is open; failing fast")
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN:
+                # Only one trial call at a time
+                self.rejected += 1
+                raise CircuitOpenError("Provider circuit is half-open; trial call in progress")
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_abandoned(self):
+        """
+        Releases the half-open trial slot after a call that ended without an outcome, e.g. cancelled.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # Back to open with the timeout already elapsed, so the next call is a new trial
+                self.state = self.OPEN
+                self._opened_at = time.monotonic() - self.reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        return {"state": self.state, "opened": self.opened, "rejected": self.rejected}
+
+
+class AdaptiveConcurrency:
+    """
+    A concurrency limit for provider calls that adapts like TCP congestion control (AIMD).
+
+    Each call that finishes within ``latency_tolerance`` times the baseline
+    latency (the lowest recently seen) while every slot was taken raises the
+    limit by ``1 / limit``, so about one per window of calls; a limit that
+    callers never reach is not raised, since it was never tested. A throttled (429) or otherwise retryable
+    failure multiplies the limit by ``backoff``, and so does sustained
+    slowness: the median of the last ``latency_window`` successful calls
+    exceeding that tolerance. A lone slow response never cuts the limit.
+    Decreases happen at most once per baseline latency, so one burst of
+    failures counts as one congestion event. Other failures leave the limit
+    alone.
+    The limit stays within ``[min_limit, max_limit]`` and is published as the
+    "concurrency_limit" gauge of ``metrics``. Calls past the limit wait, in
+    threads or in asyncio tasks alike.
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=64, backoff=0.5, latency_tolerance=2.0,
+                 latency_window=20, metrics=None):
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError("Limits must satisfy 1 <= min_limit <= initial <= max_limit")
+        if not 0 < backoff < 1:
+            raise ValueError("backoff must be between 0 and 1")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.metrics = metrics
+        self.increases = 0
+        self.decreases = 0
+        self.throttled = 0
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._baseline = None
+        self._recent = deque(maxlen=latency_window)
+        self._last_decrease = float("-inf")
+        # Classifies failures the same way retries do
+        self._retry = RetryPolicy()
+        self._condition = threading.Condition()
+        # (loop, future) for every asyncio task waiting for a slot
+        self._waiters = []
+        if metrics is not None:
+            metrics.set_gauge("concurrency_limit", self.limit)
+
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self._limit))
+
+    def slot(self):
+        """
+        Returns a context manager, usable with ``with`` or ``async with``, that holds one call slot.
+        """
+        return _ConcurrencySlot(self)
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < self.limit:
+                    self._in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, latency=None, error=None):
+        """
+        Frees a slot and adapts the limit to the call's ``latency`` and ``error``.
+
+        Pass ``latency=None`` for calls that were cancelled and say nothing about the provider.
+        """
+        with self._condition:
+            saturated = self._in_flight >= self.limit
+            self._in_flight -= 1
+            if latency is not None:
+                self._adapt(latency, error, saturated)
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def observe(self, latency, error):
+        """
+        Adapts the limit to a failed attempt made while a slot was already held, e.g. a retry.
+        """
+        with self._condition:
+            self._adapt(latency, error, False)
+
+    def _adapt(self, latency, error, saturated):
+        throttled = getattr(error, "status_code", None) == 429
+        self.throttled += throttled
+        slow = False
+        fast = error is None and (self._baseline is None or latency <= self.latency_tolerance * self._baseline)
+        if error is None:
+            self._recent.append(latency)
+            # Judge the median of a half-full window at least, never a single sample
+            if self._baseline is not None and 2 * len(self._recent) >= self._recent.maxlen:
+                slow = _nearest_rank(sorted(self._recent), 50) > self.latency_tolerance * self._baseline
+            # Track the fastest recent latency, drifting up slowly so the baseline follows the provider
+            self._baseline = latency if self._baseline is None else min(
+                latency, self._baseline + 0.01 * (latency - self._baseline))
+        if throttled or slow or (error is not None and self._retry.is_retryable(error)):
+            now = time.monotonic()
+            if now - self._last_decrease >= (self._baseline or latency):
+                self._last_decrease = now
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+                self.decreases += 1
+                # Latencies from before the decrease say nothing about the new limit
+                self._recent.clear()
+        elif fast and saturated and self._limit < self.max_limit:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self.increases += 1
+        else:
+            return
+        if self.metrics is not None:
+            self.metrics.set_gauge("concurrency_limit", self.limit)
+
+    def stats(self):
+        with self._condition:
+            return {"limit": self.limit, "in_flight": self._in_flight, "increases": self.increases,
+                    "decreases": self.decreases, "throttled": self.throttled}
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _ConcurrencySlot:
+    # Holds one AdaptiveConcurrency slot around a provider call and reports how it went
+    __slots__ = ("limiter", "start")
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def __enter__(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.limiter is not None:
+            self.limiter.release(time.perf_counter() - self.start, exc)
+        return False
+
+    async def __aenter__(self):
+        if self.limiter is not None:
+            await self.limiter.aacquire()
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.limiter is not None:
+            cancelled = exc_type is not None and issubclass(exc_type, asyncio.CancelledError)
+            self.limiter.release(None if cancelled else time.perf_counter() - self.start, exc)
+        return False
+
+
+# Used when no limiter is configured
+_NO_SLOT = _ConcurrencySlot(None)
+
+
+class LLMClient:
+    """
+    Owns the provider configuration and connection pool shared by MedReferral instances.
+
+    The API key, API base, timeout and any extra ``options`` (e.g.
+    ``api_version``) are passed with every call, so nothing is written to
+    global litellm state. With ``api_key=None`` LiteLLM reads the provider's
+    usual environment variable. Sync calls reuse LiteLLM's pooled HTTP client
+    for this configuration; with ``max_connections`` set, async calls also share
+    one keep-alive aiohttp session per event loop instead of LiteLLM's default.
+    Configuration is read-only after construction, so one client is safe to
+    share across threads and event loops.
+    """
+
+    def __init__(self, api_key=None, api_base=None, timeout=None, max_connections=None,
+                 keepalive_timeout=30.0, **options):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.options = options
+        self._config = dict(options)
+        for name in ("api_key", "api_base", "timeout"):
+            if getattr(self, name) is not None:
+                self._config[name] = getattr(self, name)
+        self._sessions = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def completion(self, **kwargs):
+        return litellm.completion(**{**self._config, **kwargs})
+
+    async def acompletion(self, **kwargs):
+        if self.max_connections is not None:
+            kwargs.setdefault("shared_session", self._session())
+        return await litellm.acompletion(**{**self._config, **kwargs})
+
+    def _session(self):
+        """
+        Returns the pooled aiohttp session for the running event loop, creating it on first use.
+        """
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                                 keepalive_timeout=self.keepalive_timeout)
+                session = self._sessions[loop] = aiohttp.ClientSession(connector=connector)
+            return session
+
+    async def aclose(self):
+        """
+        Closes the pooled session of the running event loop, if there is one.
+        """
+        with self._lock:
+            session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+# Shared by every MedReferral and ResilientBackend created without a backend
+_DEFAULT_CLIENT = LLMClient()
+
+
+class ResilientBackend:
+    """
+    Wraps a litellm-compatible backend with retries, rate limiting and a circuit breaker.
+
+    Any of ``retry``, ``rate_limiter`` and ``circuit_breaker`` may be None to
+    disable that part. Only retryable errors (timeouts, connection errors, 429s
+    and 5xx responses) count against the circuit breaker.
+
+    MedReferral's AdaptiveConcurrency slot wraps this whole retry loop, so
+    errors that are retried never reach it. Pass the same limiter as
+    ``concurrency`` to report each retried failure to it as well.
+    """
+
+    def __init__(self, backend=None, retry=None, rate_limiter=None, circuit_breaker=None, metrics=None,
+                 concurrency=None):
+        self.backend = _DEFAULT_CLIENT if backend is None else backend
+        self.retry = RetryPolicy() if retry is None else retry
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+        self.concurrency = concurrency
+
+    def completion(self, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_call()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.backend.completion(**kwargs)
+            except Exception as e:
+                delay = self._on_failure(attempt, e, time.perf_counter() - start)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._on_abandoned()
+                raise
+            self._on_success()
+            return response
+
+    async def acompletion(self, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_call()
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            start = time.perf_counter()
+            try:
+                response = await self.backend.acompletion(**kwargs)
+            except Exception as e:
+                delay = self._on_failure(attempt, e, time.perf_counter() - start)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled, e.g. by a timeout or a losing hedge
+                self._on_abandoned()
+                raise
+            self._on_success()
+            return response
+
+    def _on_success(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+
+    def _on_abandoned(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_abandoned()
+
+    def _on_failure(self, attempt, error, latency):
+        """
+        Records a failed attempt and returns the retry delay, re-raising when giving up.
+        """
+        if self.circuit_breaker is not None:
+            if self.retry.is_retryable(error):
+                self.circuit_breaker.record_failure()
+            else:
+                # The provider answered; the request itself was bad
+                self.circuit_breaker.record_success()
+        delay = self.retry.delay(attempt, error)
+        self.retry.record(delay is not None, error)
+        if self.metrics is not None:
+            if delay is not None:
+                self.metrics.increment("retries")
+            elif self.retry.is_retryable(error):
+                self.metrics.increment("retries_exhausted")
+        if delay is None:
+            # The caller's slot reports the final failure
+            raise error
+        if self.concurrency is not None:
+            self.concurrency.observe(latency, error)
+        return delay
+
+    def stats(self):
+        """
+        Returns the counters of every enabled part, keyed by part.
+        """
+        stats = {"retry": self.retry.stats()}
+        if self.rate_limiter is not None:
+            stats["rate_limiter"] = self.rate_limiter.stats()
+        if self.circuit_breaker is not None:
+            stats["circuit_breaker"] = self.circuit_breaker.stats()
+        return stats
+
+
+class CassetteMissError(LookupError):
+    """
+    Raised in replay mode for a request that is not on the cassette.
+    """
+
+
+class _ReplayStream:
+    """
+    A one-chunk stand-in for a streamed completion, iterable sync or async.
+    """
+
+    def __init__(self, content):
+        self._chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])]
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+class CassetteBackend:
+    """
+    Records completions to an append-only cassette file and replays them offline.
+
+    ``mode`` is "replay" (serve recorded answers, raise CassetteMissError for
+    anything else), "record" (always call ``backend`` and append the answer)
+    or "auto" (replay hits, record misses). Each line of the cassette is a
+    request hash, a tab and a JSON record of the answer text and token usage,
+    so appending never rewrites the file and later recordings win. Replay
+    memory-maps the file and indexes it by hash once; records are decoded
+    only when served. Transport options (keys, timeouts, sessions, ``stream``)
+    are left out of the hash, and streamed requests are recorded as plain
+    completions and replayed as a single chunk.
+    """
+
+    _transport_options = frozenset(
+        ("api_key", "api_base", "api_version", "timeout", "shared_session", "stream", "extra_headers")
+    )
+
+    def __init__(self, path, mode="replay", backend=None):
+        if mode not in ("replay", "record", "auto"):
+            raise ValueError('mode must be "replay", "record" or "auto"')
+        if mode == "replay" and not os.path.exists(path):
+            raise FileNotFoundError(f"No cassette at {path}")
+        self.path = path
+        self.mode = mode
+        self.backend = _DEFAULT_CLIENT if backend is None else backend
+        self.hits = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        # Request hash to the offset of its JSON record in ``_map``
+        self._index = {}
+        # Records appended by this instance, which the map does not cover
+        self._new = {}
+        if mode != "record" and os.path.exists(path) and os.path.getsize(path):
+            self._load_index()
+
+    def _load_index(self):
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        position = 0
+        size = len(self._map)
+        while position < size:
+            end = self._map.find(b"\n", position)
+            if end == -1:
+                # A torn final line from an interrupted recording
+                break
+            tab = self._map.find(b"\t", position, end)
+            if tab != -1:
+                self._index[self._map[position:tab].decode()] = tab + 1
+            position = end + 1
+
+    @classmethod
+    def request_key(cls, kwargs):
+        """
+        Returns the hash identifying a completion request on the cassette.
+        """
+        request = {name: value for name, value in kwargs.items() if name not in cls._transport_options}
+        encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+
+    def completion(self, **kwargs):
+        key = self.request_key(kwargs)
+        record = self._lookup(key)
+        if record is None:
+            request = {name: value for name, value in kwargs.items() if name != "stream"}
+            record = self._record(key, kwargs, self.backend.completion(**request))
+        return self._response(record, kwargs.get("stream"))
+
+    async def acompletion(self, **kwargs):
+        key = self.request_key(kwargs)
+        record = self._lookup(key)
+        if record is None:
+            request = {name: value for name, value in kwargs.items() if name != "stream"}
+            record = self._record(key, kwargs, await self.backend.acompletion(**request))
+        return self._response(record, kwargs.get("stream"))
+
+    def _lookup(self, key):
+        if self.mode == "record":
+            return None
+        with self._lock:
+            record = self._new.get(key)
+            offset = self._index.get(key)
+            if record is None and offset is not None:
+                record = json.loads(self._map[offset:self._map.find(b"\n", offset)])
+            if record is not None:
+                self.hits += 1
+                return record
+        if self.mode == "replay":
+            raise CassetteMissError(f"Request {key} is not on the cassette {self.path}")
+        return None
+
+    def _record(self, key, request, response):
+        prompt_tokens, completion_tokens, cached_tokens = _usage_tokens(response)
+        messages = request.get("messages") or [{}]
+        record = {
+            "model": request.get("model"),
+            "question": messages[-1].get("content"),
+            "content": response.choices[0].message.content or "",
+            "usage": [prompt_tokens, completion_tokens, cached_tokens],
+        }
+        line = f"{key}\t{json.dumps(record, separators=(',', ':'))}\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            self._new[key] = record
+            self.recorded += 1
+        return record
+
+    @staticmethod
+    def _response(record, stream=False):
+        if stream:
+            return _ReplayStream(record["content"])
+        prompt_tokens, completion_tokens, cached_tokens = record["usage"]
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=record["content"]))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+            ),
+        )
+
+    def stats(self):
+        return {"mode": self.mode, "entries": len(self._index.keys() | self._new.keys()),
+                "hits": self.hits, "recorded": self.recorded}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._index.clear()
+
+
+# The hand-written few-shot examples; each one shows a multi-specialist answer
+DEFAULT_FEW_SHOT = (
+    ("I have chest pain and shortness of breath.", ("Cardiologist", "Pulmonologist")),
+    ("I have severe joint pain and swelling.", ("Rheumatologist", "Orthopedic Surgeon")),
+    ("I have blurry vision and headaches.", ("Ophthalmologist", "Neurologist")),
+)
+
+
+class PromptTemplate:
+    """
+    Builds the prompts sent to the model.
+
+    The instructions and few-shot examples form a static system message that
+    is rendered once, without indentation whitespace; only the short user
+    message changes per question. ``token_budget`` caps the size of that
+    static prefix: examples are added in order only while they fit.
+
+    Because the prefix comes first and is byte-identical across requests,
+    providers with automatic prefix caching (OpenAI, Gemini) reuse it as is.
+    Anthropic models need the prefix marked explicitly; ``cache_control``
+    is "auto" to mark it for Claude models only, or True/False to force it.
+    Providers only cache prefixes of at least ``min_cache_tokens`` tokens
+    (1024, or 2048 for Claude Haiku), so "auto" leaves shorter prefixes,
+    including the default prompt, unmarked.
+
+    With ``output="json"`` the prompt lists every specialist under a numeric
+    code and asks for ``{"codes": [...]}`` instead of free text, which keeps
+    answers to a handful of tokens and lets ``decode`` skip name matching.
+    """
+
+    instructions = (
+        "You are a medical assistant. Based on the given medical question, "
+        "recommend the most suitable specialist doctors.\n"
+        "Some symptoms may require consultation with multiple specialists.\n"
+    )
+
+    _code_fence = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+    min_cache_tokens = 1024
+
+    def __init__(self, examples=DEFAULT_FEW_SHOT, token_budget=None, model=None, cache_control="auto",
+                 output="text"):
+        if output not in ("text", "json"):
+            raise ValueError('output must be "text" or "json"')
+        self.model = model
+        self.token_budget = token_budget
+        self.cache_control = cache_control
+        self.output = output
+        # In JSON mode, code i stands for codes[i], the specialist with registry ID i
+        self.codes = SPECIALIST_REGISTRY.names
+        self._code_of = {name: code for code, name in enumerate(self.codes)}
+        self.examples = self._fit_examples(tuple(examples))
+        self.system_prompt = self._render_system(self.examples)
+        self.packed_system_prompt = self._render_packed_system(self.examples)
+        self._prefix_tokens = None
+
+    @classmethod
+    def from_examples_file(cls, path=EXAMPLES_PATH, token_budget=400, per_specialist=1, model=None,
+                           cache_control="auto", output="text"):
+        """
+        Builds a template whose few-shot examples come from ``examples.json``.
+
+        Takes ``per_specialist`` questions from each specialist in turn, so a
+        tight budget still covers as many specialists as possible.
+        """
+        with open(path) as f:
+            corpus = json.load(f)
+        examples = [(questions[i], (specialist,))
+                    for i in range(per_specialist)
+                    for specialist, questions in corpus.items() if i < len(questions)]
+        return cls(examples, token_budget, model, cache_control, output)
+
+    def _render_system(self, examples):
+        if self.output == "json":
+            return self._render_json_system(examples)
+        prompt = (self.instructions +
+                  'Answer with one line: "Specialists: " followed by a comma-separated list.\n')
+        if examples:
+            prompt += "\nExamples:\n" + "\n\n".join(
+                f'Question: "{q}"\nSpecialists: {", ".join(s)}' for q, s in examples
+            ) + "\n"
+        return prompt
+
+    def _render_json_system(self, examples):
+        prompt = (self.instructions + "Specialist codes:\n"
+                  + "\n".join(f"{code}: {name}" for code, name in enumerate(self.codes))
+                  + '\nAnswer with only JSON of the form {"codes": [...]} listing the codes '
+                  "of the recommended specialists.\n")
+        if examples:
+            prompt += "\nExamples:\n" + "\n\n".join(
+                f'Question: "{q}"\n{self._encode(s)}' for q, s in examples
+            ) + "\n"
+        return prompt
+
+    def _encode(self, specialists):
+        return json.dumps({"codes": [self._code_of[name] for name in specialists]}, separators=(",", ":"))
+
+    @property
+    def response_format(self):
+        """
+        The JSON schema constraining answers in JSON mode, in LiteLLM's ``response_format`` shape.
+        """
+        if self.output != "json":
+            return None
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "referral",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "codes": {"type": "array", "items": {"type": "integer", "enum": list(range(len(self.codes)))}},
+                    },
+                    "required": ["codes"],
+                    "additionalProperties": False,
+                },
+            },
+        }
+
+    def decode(self, text):
+        """
+        Strictly decodes a JSON answer into canonical specialist names.
+
+        Accepts ``{"codes": [...]}`` or a bare array of integer codes, optionally
+        inside a Markdown code fence. Returns None for anything else, so the
+        caller can fall back to the free-text parser.
+        """
+        try:
+            value = json.loads(self._code_fence.sub("", text.strip()))
+        except ValueError:
+            return None
+        if isinstance(value, dict):
+            value = value.get("codes")
+        if not isinstance(value, list):
+            return None
+        for code in value:
+            if type(code) is not int or not 0 <= code < len(self.codes):
+                return None
+        return tuple(dict.fromkeys(self.codes[code] for code in value))
+
+    def _render_packed_system(self, examples):
+        prompt = (self.instructions +
+                  "You will receive several numbered questions. Answer each on its own line "
+                  'as "<number>. Specialists: " followed by a comma-separated list.\n')
+        if examples:
+            prompt += (
+                "\nExamples:\n"
+                + "\n".join(f'{i}. Question: "{q}"' for i, (q, _) in enumerate(examples, 1))
+                + "\n\n"
+                + "\n".join(f'{i}. Specialists: {", ".join(s)}' for i, (_, s) in enumerate(examples, 1))
+                + "\n"
+            )
+        return prompt
+
+    def _fit_examples(self, examples):
+        if self.token_budget is None:
+            return examples
+        fitted = ()
+        for example in examples:
+            if self.count_tokens(self._render_system(fitted + (example,))) > self.token_budget:
+                break
+            fitted += (example,)
+        return fitted
+
+    def messages(self, question):
+        return [{"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": f'Question: "{question}"'}]
+
+    def packed_messages(self, questions):
+        numbered = "\n".join(f'{i}. Question: "{q}"' for i, q in enumerate(questions, 1))
+        return [{"role": "system", "content": self.packed_system_prompt},
+                {"role": "user", "content": numbered}]
+
+    def provider_messages(self, messages, model):
+        """
+        Returns ``messages`` with the static system prefix marked for prompt caching
+        when ``model`` needs explicit markers, or ``messages`` unchanged otherwise.
+        """
+        if messages[0]["role"] != "system" or not self._wants_cache_control(model, messages[0]["content"]):
+            return messages
+        system = dict(messages[0], content=[{
+            "type": "text",
+            "text": messages[0]["content"],
+            "cache_control": {"type": "ephemeral"},
+        }])
+        return [system] + messages[1:]
+
+    def _wants_cache_control(self, model, system):
+        if self.cache_control != "auto":
+            return bool(self.cache_control)
+        # Claude models take explicit cache_control markers on every provider route
+        if "claude" not in model.lower() and not model.startswith("anthropic/"):
+            return False
+        # A marker on a prefix below the provider minimum is ignored, so skip it
+        tokens = self.prefix_tokens if system == self.system_prompt else self.count_tokens(system)
+        return tokens >= self.min_cache_tokens
+
+    @property
+    def prefix_tokens(self):
+        """
+        Token count of the static system prompt, computed once.
+        """
+        if self._prefix_tokens is None:
+            self._prefix_tokens = self.count_tokens(self.system_prompt)
+        return self._prefix_tokens
+
+    def estimate_tokens(self, question):
+        """
+        Estimates the prompt tokens of a request for ``question``.
+        """
+        return self.prefix_tokens + self.count_tokens(f'Question: "{question}"')
+
+    def count_tokens(self, text):
+        try:
+            return litellm.token_counter(model=self.model or "gpt-4o", text=text)
+        except Exception:
+            # Roughly four characters per token for English text
+            return len(text) // 4 + 1
+
+
+class RecommendationStatus(enum.Enum):
+    """
+    The outcome of a referral request.
+    """
+    OK = "ok"                  # at least one known specialist was recommended
+    UNVERIFIED = "unverified"  # the model answered but named no known specialist
+    ERROR = "error"            # the request failed
+
+
+class Recommendation:
+    """
+    The structured result of a referral request.
+
+    ``specialists`` is a tuple of canonical names from ``MedReferral.medical_specialists``,
+    ``raw`` the model's answer text (empty for local answers) and ``error`` the failure
+    message when ``status`` is ERROR. ``source`` says where the answer came from:
+    "llm", "cache" or "classifier". ``str()`` renders the string returned by
+    ``get_specialist_recommendation``.
+    """
+
+    __slots__ = ("specialists", "status", "raw", "model", "prompt_tokens",
+                 "completion_tokens", "latency", "source", "error", "cached_tokens")
+
+    def __init__(self, specialists=(), status=RecommendationStatus.OK, raw="", model=None,
+                 prompt_tokens=0, completion_tokens=0, latency=0.0, source="llm", error=None,
+                 cached_tokens=0):
+        self.specialists = specialists
+        self.status = status
+        self.raw = raw
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.latency = latency
+        self.source = source
+        self.error = error
+        # Prompt tokens the provider served from its prefix cache
+        self.cached_tokens = cached_tokens
+
+    @classmethod
+    def failed(cls, error, model=None, latency=0.0):
+        return cls((), RecommendationStatus.ERROR, "", model, latency=latency, error=error)
+
+    def __str__(self):
+        if self.status is RecommendationStatus.OK:
+            return ", ".join(self.specialists)
+        if self.status is RecommendationStatus.ERROR:
+            return f"Error: {self.error}"
+
+        match = re.search(r"Specialists?:\s*(.*)", self.raw)
+        if match:
+            specialists = match.group(1)
+        elif self.specialists:
+            specialists = ", ".join(self.specialists)
+        else:
+            specialists = "Unknown Specialists (Please verify with a healthcare professional.)"
+        return f"{specialists} (Note: Please verify with a healthcare professional.)"
+
+    @property
+    def mask(self):
+        """
+        The specialists as a ``SPECIALIST_REGISTRY`` bit mask.
+        """
+        return SPECIALIST_REGISTRY.encode(self.specialists)
+
+    def __repr__(self):
+        return (f"Recommendation(specialists={self.specialists!r}, status={self.status.name}, "
+                f"source={self.source!r}, latency={self.latency:.3f})")
+
+    def to_dict(self):
+        """
+        Returns a JSON-serializable dict of every field.
+        """
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result["specialists"] = list(self.specialists)
+        result["status"] = self.status.value
+        return result
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["specialists"] = tuple(data["specialists"])
+        data["status"] = RecommendationStatus(data["status"])
+        return cls(**data)
+
+
+def _usage_tokens(response):
+    """
+    Returns ``(prompt_tokens, completion_tokens, cached_tokens)`` from a response.
+
+    Cached tokens are read from OpenAI-style ``prompt_tokens_details`` or
+    Anthropic-style ``cache_read_input_tokens``. Unreported counts are zero.
+    """
+    usage = getattr(response, "usage", None)
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    if not isinstance(cached, int):
+        cached = getattr(usage, "cache_read_input_tokens", 0)
+    tokens = (getattr(usage, "prompt_tokens", 0), getattr(usage, "completion_tokens", 0), cached)
+    return tuple(value if isinstance(value, int) else 0 for value in tokens)
+
+
+# Returned for every stage when metrics are disabled, so timing costs one check
+_NO_STAGE = contextlib.nullcontext()
+
+
+class _StageTimer:
+    __slots__ = ("metrics", "name", "start", "span")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.span = None
+        if self.metrics.tracer is not None:
+            self.span = self.metrics.tracer.start_as_current_span(f"medrefer.{self.name}")
+            self.span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if self.span is not None:
+            self.span.__exit__(*exc_info)
+        return False
+
+
+class Metrics:
+    """
+    Collects per-stage timings, token usage and outcome counts for MedReferral.
+
+    Pass one instance as ``metrics=`` to MedReferral, and to ResilientBackend
+    to count retries. The stages are "recommend" (the whole call), "prompt",
+    "lookup" (caches and classifier), "request" (waiting on the provider),
+    "parse" and "validate". Each of ``hooks`` is called as ``hook(stage,
+    seconds)`` when a stage ends. With an OpenTelemetry ``tracer``, every
+    stage is also recorded as a span. Gauges such as AdaptiveConcurrency's
+    "concurrency_limit" hold the last value set with ``set_gauge``.
+    """
+
+    # Histogram bucket upper bounds in seconds for the Prometheus export
+    buckets = (0.0001, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, hooks=(), tracer=None):
+        self.hooks = list(hooks)
+        self.tracer = tracer
+        self._lock = threading.Lock()
+        # stage -> [count, total seconds, per-bucket counts]
+        self._stages = {}
+        self._outcomes = Counter()
+        self._tokens = Counter()
+        self._counters = Counter()
+        self._gauges = {}
+        self._specialists = Counter()
+
+    @classmethod
+    def with_opentelemetry(cls, hooks=()):
+        """
+        Returns Metrics that also emit spans through the global OpenTelemetry tracer provider.
+        """
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError("Metrics.with_opentelemetry requires opentelemetry-api "
+                              "(pip install opentelemetry-api)") from None
+        return cls(hooks, trace.get_tracer("medrefer"))
+
+    def stage(self, name):
+        """
+        Returns a context manager that times the stage ``name``.
+        """
+        return _StageTimer(self, name)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [0, 0.0, [0] * len(self.buckets)]
+            entry[0] += 1
+            entry[1] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[2][i] += 1
+                    break
+        for hook in self.hooks:
+            hook(stage, seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def record(self, result):
+        """
+        Counts a finished Recommendation by source, status, tokens and specialists.
+        """
+        with self._lock:
+            self._outcomes[result.source, result.status.value] += 1
+            self._tokens["prompt"] += result.prompt_tokens
+            self._tokens["completion"] += result.completion_tokens
+            self._tokens["cached"] += result.cached_tokens
+            for specialist in result.specialists:
+                self._specialists[specialist] += 1
+
+    def snapshot(self):
+        """
+        Returns every metric as a JSON-serializable dict.
+        """
+        with self._lock:
+            requests = sum(self._outcomes.values())
+            cached = sum(n for (source, _), n in self._outcomes.items() if source.endswith("cache"))
+            return {
+                "stages": {
+                    stage: {"count": count, "total_s": total, "mean_s": total / count}
+                    for stage, (count, total, _) in sorted(self._stages.items())
+                },
+                "recommendations": requests,
+                "outcomes": {f"{source}/{status}": n for (source, status), n in sorted(self._outcomes.items())},
+                "cache_hit_rate": cached / requests if requests else 0.0,
+                "tokens": dict(self._tokens),
+                "retries": self._counters["retries"],
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "specialists": dict(self._specialists.most_common()),
+            }
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            lines += ["# HELP medrefer_stage_seconds Time spent in each referral stage.",
+                      "# TYPE medrefer_stage_seconds histogram"]
+            for stage, (count, total, bucket_counts) in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, bucket_counts):
+                    cumulative += n
+                    lines.append(f'medrefer_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'medrefer_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'medrefer_stage_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'medrefer_stage_seconds_count{{stage="{stage}"}} {count}')
+
+            lines += ["# HELP medrefer_recommendations_total Recommendations by source and status.",
+                      "# TYPE medrefer_recommendations_total counter"]
+            for (source, status), n in sorted(self._outcomes.items()):
+                lines.append(f'medrefer_recommendations_total{{source="{source}",status="{status}"}} {n}')
+
+            lines += ["# HELP medrefer_tokens_total Tokens reported by the provider.",
+                      "# TYPE medrefer_tokens_total counter"]
+            for kind, n in sorted(self._tokens.items()):
+                lines.append(f'medrefer_tokens_total{{kind="{kind}"}} {n}')
+
+            for name, n in sorted(self._counters.items()):
+                lines += [f"# TYPE medrefer_{name}_total counter", f"medrefer_{name}_total {n}"]
+
+            for name, value in sorted(self._gauges.items()):
+                lines += [f"# TYPE medrefer_{name} gauge", f"medrefer_{name} {value}"]
+
+            lines += ["# HELP medrefer_specialist_recommendations_total Times each specialist was recommended.",
+                      "# TYPE medrefer_specialist_recommendations_total counter"]
+            for specialist, n in sorted(self._specialists.items()):
+                label = specialist.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'medrefer_specialist_recommendations_total{{specialist="{label}"}} {n}')
+        return "\n".join(lines) + "\n"
+
 
 class MedReferral:
     """
     A class for determining the appropriate medical specialists based on a given question using OpenAI GPT model.
+
+    One instance is meant to be shared by every thread of a server. Its
+    configuration is read-only after construction; the request path keeps no
+    per-call state on the instance, and the shared parts (caches, backends,
+    Metrics, the resilience wrappers and the hedging counters) lock their own
+    state. The memoized template hash and schema-support lookups may be
+    computed twice by racing threads, which is harmless since both compute the
+    same value. ``submit`` runs requests on a built-in pool of ``max_workers``
+    threads with room for ``max_pending`` more, blocking callers beyond that.
     """
-    medical_specialists = frozenset(
-        [
-            "Allergist",
-            "Anesthesiologist",
-            "Cardiologist",
-            "Cardiothoracic Surgeon",
-            "Colorectal Surgeon",
-            "Child and Adolescent Psychiatrist",
-            "Dermatologist",
-            "Endocrinologist",
-            "Forensic Psychiatrist",
-            "Gastroenterologist",
-            "General Surgeon",
-            "Geriatrician",
-            "Geriatric Psychiatrist",
-            "Gynecologist",
-            "Hematologist",
-            "Infectious Disease Specialist",
-            "Internal Medicine Doctor (Internist)",
-            "Immunologist",
-            "Maternal-Fetal Medicine Specialist",
-            "Nephrologist",
-            "Neurologist",
-            "Neurosurgeon",
-            "Neonatologist",
-            "Nuclear Medicine Specialist",
-            "Obstetrician",
-            "Occupational Medicine Specialist",
-            "Oncologist",
-            "Orthopedic Surgeon",
-            "Ophthalmologist",
-            "Otolaryngologist (ENT Specialist)",
-            "Pediatrician",
-            "Pathologist",
-            "Pulmonologist",
-            "Pediatric Surgeon",
-            "Plastic Surgeon",
-            "Physical Medicine & Rehabilitation (PM&R) Specialist",
-            "Pain Management Specialist",
-            "Psychiatrist",
-            "Rheumatologist",
-            "Radiologist",
-            "Sports Medicine Doctor",
-            "Sleep Medicine Specialist",
-            "Trauma Surgeon",
-            "Transplant Surgeon",
-            "Urologist",
-        ]
-    )
+    medical_specialists = frozenset(SPECIALIST_REGISTRY.names)
+    registry = SPECIALIST_REGISTRY
+
+    # Built once at import; maps aliases, plurals and typos to canonical names
+    matcher = SpecialistMatcher(medical_specialists, SPECIALIST_ALIASES)
     
-    def __init__(self):
-        litellm.api_key = os.getenv("OPENAI_API_KEY")
+    def __init__(self, cache=None, classifier=None, classifier_threshold=0.8, backend=None,
+                 model="gemini-2.5-flash", max_tokens=None, stream=False,
+                 hedge_percentile=None, hedge_after=2.0, hedge_min_samples=20, prompt=None,
+                 semantic_cache=None, metrics=None, output="text", max_workers=8, max_pending=32,
+                 concurrency=None):
+        # ``model`` may be an ordered fallback chain; the first entry is the primary
+        self.models = (model,) if isinstance(model, str) else tuple(model)
+        if not self.models:
+            raise ValueError("model must name at least one model")
+        self.model = self.models[0]
+        # ``output`` picks the answer format when no ``prompt`` is given:
+        # "text" (Specialists: ...) or "json" (numeric specialist codes)
+        self.prompt = PromptTemplate(model=self.model, output=output) if prompt is None else prompt
+        if max_tokens is None:
+            # A JSON list of codes needs a fraction of the free-text budget
+            max_tokens = 20 if self.prompt.output == "json" else 100
+        self.max_tokens = max_tokens
+        # Stream tokens and hang up as soon as the "Specialists:" line is complete
+        self.stream = stream
+        # Anything exposing litellm-compatible ``completion``/``acompletion``
+        # functions, such as an LLMClient; the default client looks litellm up
+        # per call so patching litellm works.
+        self.backend = _DEFAULT_CLIENT if backend is None else backend
+        self.cache = cache
+        # Consulted after the exact cache, for reworded versions of past questions
+        self.semantic_cache = semantic_cache
+        self.classifier = classifier
+        self.classifier_threshold = classifier_threshold
+        # Hedging: if the primary is slower than this percentile of its recent
+        # latencies (or ``hedge_after`` seconds until enough samples exist), the
+        # same prompt is also sent to the next model in the chain.
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.hedge_min_samples = hedge_min_samples
+        self.hedged = 0
+        self.fallbacks = 0
+        self._primary_latencies = deque(maxlen=500)
+        self._hedge_lock = threading.Lock()
+        self._hedge_executor = None
+        self._hedge_workers = 0
+        self._hedge_tasks = 0
+        self._template_hash = None
+        self._schema_support = {}
+        # Optional Metrics; every stage costs a single None check when disabled
+        self.metrics = metrics
+        # The ``submit`` pool is started on first use; each slot is a running or queued request
+        if max_workers < 1 or max_pending < 0:
+            raise ValueError("max_workers must be at least 1 and max_pending at least 0")
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Optional AdaptiveConcurrency bounding provider calls from every path
+        self.concurrency = concurrency
     
     def get_specialist_recommendation(self, question):
         """
         Determines the appropriate medical specialists for a given question.
         """
-        prompt = f"""
-        You are a medical assistant. Based on the given medical question, recommend the most suitable specialist doctors.
-        Some symptoms may require consultation with multiple specialists.
-        
-        Example format:
-        - Question: "I have chest pain and shortness of breath."
-          Specialists: Cardiologist, Pulmonologist
-        
-        - Question: "I have severe joint pain and swelling."
-          Specialists: Rheumatologist, Orthopedic Surgeon
+        return str(self.recommend(question))
+
+    def recommend(self, question):
+        """
+        Determines the appropriate medical specialists for a given question.
+
+        Returns a Recommendation; failures are reported through its status
+        rather than raised.
+        """
+        with self._stage("recommend"):
+            start = time.perf_counter()
+            with self._stage("prompt"):
+                request = self._completion_kwargs(question)
+            with self._stage("lookup"):
+                cache_key, local_answer = self._local_answer(question, request)
+            if local_answer is not None:
+                local_answer.latency = time.perf_counter() - start
+                return self._finish(local_answer)
+            return self._remote_recommend(question, request, cache_key, start)
+
+    def _remote_recommend(self, question, request, cache_key, start):
+        """
+        Sends ``request`` down the model chain and stores the result; the local lookup is already done.
+        """
+        result = self._request_chain(request)
+        if not result.prompt_tokens and result.status is not RecommendationStatus.ERROR:
+            # Streams and some providers report no usage; fall back to an estimate
+            result.prompt_tokens = self.prompt.estimate_tokens(question)
+        result.latency = time.perf_counter() - start
+        self._store(question, request, cache_key, result)
+        return self._finish(result)
+
+    def _stage(self, name):
+        return _NO_STAGE if self.metrics is None else self.metrics.stage(name)
+
+    def _slot(self):
+        return _NO_SLOT if self.concurrency is None else self.concurrency.slot()
+
+    def _batch_concurrency(self, max_concurrency):
+        """
+        Returns the worker count for a batch; a limiter can only lower ``max_concurrency``.
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if self.concurrency is None:
+            return max_concurrency
+        return min(max_concurrency, self.concurrency.max_limit)
+
+    def _finish(self, result):
+        if self.metrics is not None:
+            self.metrics.record(result)
+        return result
+
+    def _request_chain(self, request):
+        """
+        Tries each model in the chain until one returns a known specialist.
 
-        - Question: "I have blurry vision and headaches."
-          Specialists: Ophthalmologist, Neurologist
+        Returns the first OK result, else the last answer that named no known
+        specialist, else the last error.
+        """
+        models = self.models
+        result = None
+        if self.hedge_percentile is not None and len(models) > 1:
+            result = self._hedged_attempt(request, models[0], models[1])
+            models = models[2:]
+
+        for model in models:
+            if result is not None and result.status is RecommendationStatus.OK:
+                break
+            if result is not None:
+                self._count_fallback()
+            attempt = self._attempt(dict(request, model=model))
+            # Never let an error replace an answer from an earlier model
+            if (result is None or result.status is RecommendationStatus.ERROR
+                    or attempt.status is not RecommendationStatus.ERROR):
+                result = attempt
+        return result
+
+    def _attempt(self, request):
+        """
+        Sends ``request`` to its model and returns the validated Recommendation.
+        """
+        start = time.perf_counter()
+        try:
+            if self.stream:
+                with self._stage("request"), self._slot():
+                    stream = self.backend.completion(**self._provider_request(request), stream=True)
+                    text = self._consume_stream(stream)
+                result = self._parse_text(text, request["model"])
+            else:
+                with self._stage("request"), self._slot():
+                    response = self.backend.completion(**self._provider_request(request))
+                result = self._parse_response(response, request["model"])
+
+        except Exception as e:
+            return Recommendation.failed(str(e), request["model"])
+
+        if request["model"] == self.models[0]:
+            self._record_primary_latency(time.perf_counter() - start)
+        return result
+
+    def _hedged_attempt(self, request, primary, secondary):
+        """
+        Sends ``request`` to ``primary`` and, past the hedge deadline, also to ``secondary``.
+
+        The first OK answer wins. The losing request is left to finish in the
+        background, since a blocking HTTP call cannot be interrupted. The
+        deadline runs from when the primary request starts, not when it was queued.
+        """
+        started = threading.Event()
+
+        def run_primary():
+            started.set()
+            return self._attempt(dict(request, model=primary))
+
+        futures = [self._hedge_submit(run_primary)]
+        started.wait()
+        start = time.perf_counter()
+        done, _ = wait(futures, timeout=max(0.0, self._hedge_deadline() - (time.perf_counter() - start)))
+        if done and futures[0].result().status is RecommendationStatus.OK:
+            return futures[0].result()
 
-        Now, analyze the following question and recommend the best specialists:
+        if done:
+            # The primary failed before the deadline, so the secondary is a plain fallback
+            self._count_fallback()
+        else:
+            with self._hedge_lock:
+                self.hedged += 1
+        futures.append(self._hedge_submit(self._attempt, dict(request, model=secondary)))
 
-        Question: "{question}"
-        Specialists:
+        results = []
+        pending = futures
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.result().status is RecommendationStatus.OK:
+                    return future.result()
+                results.append(future.result())
+        # Neither answered usefully; prefer an answer over an error
+        results.sort(key=lambda result: result.status is RecommendationStatus.ERROR)
+        return results[0]
+
+    def _hedge_deadline(self):
+        with self._hedge_lock:
+            if len(self._primary_latencies) < self.hedge_min_samples:
+                return self.hedge_after
+            latencies = sorted(self._primary_latencies)
+        return _nearest_rank(latencies, self.hedge_percentile)
+
+    def _record_primary_latency(self, latency):
+        with self._hedge_lock:
+            self._primary_latencies.append(latency)
+
+    def _count_fallback(self):
+        with self._hedge_lock:
+            self.fallbacks += 1
+
+    def _hedge_submit(self, fn, *args):
         """
+        Runs ``fn(*args)`` on the hedging pool, growing it so a request never waits for a thread.
+        """
+        with self._hedge_lock:
+            if self._hedge_executor is None or self._hedge_tasks >= self._hedge_workers:
+                # Callers and background losers alike hold a thread; queued time would read as latency
+                old, self._hedge_workers = self._hedge_executor, max(8, 2 * self._hedge_workers)
+                self._hedge_executor = ThreadPoolExecutor(self._hedge_workers, thread_name_prefix="medrefer-hedge")
+                if old is not None:
+                    old.shutdown(wait=False)
+            self._hedge_tasks += 1
+            future = self._hedge_executor.submit(fn, *args)
+        future.add_done_callback(self._hedge_task_done)
+        return future
+
+    def _hedge_task_done(self, future):
+        with self._hedge_lock:
+            self._hedge_tasks -= 1
 
+    def _consume_stream(self, stream):
+        """
+        Reads a streamed completion until the specialists line is complete, then closes it.
+        """
+        scanner = SpecialistLineScanner()
         try:
-            response = litellm.completion(
-                model="gemini-2.5-flash",
-                messages=[{"role": "system", "content": "You are a helpful medical assistant."},
-                          {"role": "user", "content": prompt}],
-                max_tokens=100
-            )
+            for chunk in stream:
+                if scanner.feed(_chunk_text(chunk)):
+                    break
+        finally:
+            _close_stream(stream)
+        return scanner.text
+
+    def _local_answer(self, question, request):
+        """
+        Answers from the cache or the local classifier without calling the LLM.
+
+        Returns ``(cache_key, recommendation)``; ``recommendation`` is None when
+        the LLM is needed.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(question, request)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cache_key, self._cached_recommendation(cached, "cache")
+
+        if self.semantic_cache is not None:
+            cached = self.semantic_cache.get(question, self._cache_namespace(request))
+            if cached is not None:
+                return cache_key, self._cached_recommendation(cached, "semantic_cache")
+
+        if self.classifier is not None:
+            specialist, confidence = self.classifier.predict(question)
+            if specialist is not None and confidence >= self.classifier_threshold:
+                return cache_key, Recommendation((specialist,), source="classifier")
+
+        return cache_key, None
 
-            # Extract the content of the response
-            full_response = response.choices[0].message.content.strip()
+    @staticmethod
+    def _cached_recommendation(cached, source):
+        result = Recommendation.from_dict(json.loads(cached))
+        # Nothing was spent on this answer
+        result.source = source
+        result.prompt_tokens = result.completion_tokens = result.cached_tokens = 0
+        return result
 
+    def _store(self, question, request, cache_key, result):
+        if result.status is RecommendationStatus.ERROR:
+            return
+        if cache_key is not None:
+            self.cache.set(cache_key, json.dumps(result.to_dict()))
+        if self.semantic_cache is not None:
+            self.semantic_cache.set(question, json.dumps(result.to_dict()), self._cache_namespace(request))
+
+    def _cache_namespace(self, request):
+        """
+        Identifies the model, prompt template and max_tokens an answer was produced with.
+        """
+        if self._template_hash is None:
+            template = self._completion_kwargs("\0")["messages"]
+            self._template_hash = hashlib.sha256(
+                json.dumps(template, sort_keys=True).encode()
+            ).hexdigest()
+        return "\0".join((request["model"], self._template_hash, str(request["max_tokens"])))
+
+    def _cache_key(self, question, request):
+        """
+        Builds the cache key from the normalized question, model, prompt template and max_tokens.
+        """
+        key = "\0".join((self._cache_namespace(request), normalize_question(question)))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _completion_kwargs(self, question):
+        """
+        Builds the keyword arguments for a completion request.
+
+        Shared by the sync and async paths so both send identical prompts.
+        """
+        request = {
+            "model": self.model,
+            "messages": self.prompt.messages(question),
+            "max_tokens": self.max_tokens,
+        }
+        if self.prompt.response_format is not None:
+            request["response_format"] = self.prompt.response_format
+        return request
+
+    def _provider_request(self, request):
+        """
+        Applies provider-specific prompt caching markers and schema support to a request before it is sent.
+        """
+        messages = self.prompt.provider_messages(request["messages"], request["model"])
+        if messages is not request["messages"]:
+            request = dict(request, messages=messages)
+        if "response_format" in request and not self._supports_schema(request["model"]):
+            # The prompt alone asks for JSON; the strict decoder and fallback cope with the rest
+            request = {key: value for key, value in request.items() if key != "response_format"}
+        return request
+
+    def _supports_schema(self, model):
+        supported = self._schema_support.get(model)
+        if supported is None:
+            try:
+                supported = bool(litellm.supports_response_schema(model=model))
+            except Exception:
+                supported = False
+            self._schema_support[model] = supported
+        return supported
+
+    def _parse_response(self, response, model):
+        """
+        Extracts and validates the recommended specialists from a completion response.
+        """
+        # Extract the content of the response
+        result = self._parse_text(response.choices[0].message.content, model)
+        result.prompt_tokens, result.completion_tokens, result.cached_tokens = _usage_tokens(response)
+        return result
+
+    def _parse_text(self, full_response, model):
+        with self._stage("parse"):
+            full_response = full_response.strip()
+            if self.prompt.output == "json":
+                specialists = self.prompt.decode(full_response)
+                if specialists is not None:
+                    status = RecommendationStatus.OK if specialists else RecommendationStatus.UNVERIFIED
+                    return Recommendation(specialists, status, full_response, model)
             # Use regex to extract only the specialist names
             match = re.search(r"Specialists?:\s*(.*)", full_response)
-            if match:
-                specialists = match.group(1)
-            else:
-                specialists = "Unknown Specialists (Please verify with a healthcare professional.)"
+        if match:
+            valid_specialists = self._valid_specialists(match.group(1))
+            status = RecommendationStatus.OK if valid_specialists else RecommendationStatus.UNVERIFIED
+        else:
+            # Without the answer line, names in the prose are only candidates:
+            # "you do not need a Cardiologist" mentions one too
+            valid_specialists = self._valid_specialists(full_response)
+            status = RecommendationStatus.UNVERIFIED
+        return Recommendation(tuple(valid_specialists), status, full_response, model)
+
+    def _valid_specialists(self, specialists):
+        """
+        Maps the specialists mentioned in ``specialists`` to canonical names in the predefined list.
+        """
+        with self._stage("validate"):
+            return self.matcher.find(specialists)
+
+    def _packed_completion_kwargs(self, questions):
+        """
+        Builds a single completion request that classifies several numbered questions.
+        """
+        return {
+            "model": self.model,
+            "messages": self.prompt.packed_messages(questions),
+            "max_tokens": self.max_tokens * len(questions),
+        }
 
-            # Ensure specialists are in the predefined list and return only valid specialists
-            recommended_specialists = [s.strip() for s in specialists.split(",")]
-            valid_specialists = [s for s in recommended_specialists if s in self.medical_specialists]
+    def _parse_packed_response(self, response):
+        """
+        Extracts ``{number: specialists}`` from a packed completion response.
 
+        Lines without any valid specialist are left out so the caller can retry
+        those questions individually.
+        """
+        full_response = response.choices[0].message.content
+        answers = {}
+        for number, specialists in re.findall(
+            r"^\s*(\d+)[.):]\s*Specialists?:\s*(.*)$", full_response, re.MULTILINE
+        ):
+            valid_specialists = self._valid_specialists(specialists)
             if valid_specialists:
-                return ", ".join(valid_specialists)
+                answers[int(number)] = tuple(valid_specialists)
+        return answers
+
+    def _recommend_pack(self, questions):
+        """
+        Recommends specialists for ``questions`` using one packed completion.
+
+        Questions answered by the cache or classifier are not sent. Any question
+        missing from the packed answer falls back to a single request through
+        the model chain, without repeating the cache and classifier lookup. Token
+        counts of the packed completion are split evenly across its answers.
+        """
+        start = time.perf_counter()
+        results = [None] * len(questions)
+        pending = []
+        for position, question in enumerate(questions):
+            single_request = self._completion_kwargs(question)
+            cache_key, local_answer = self._local_answer(question, single_request)
+            if local_answer is not None:
+                local_answer.latency = time.perf_counter() - start
+                results[position] = local_answer
+            else:
+                pending.append((position, question, single_request, cache_key))
+
+        if len(pending) > 1:
+            request = self._packed_completion_kwargs([question for _, question, _, _ in pending])
+            prompt_tokens = completion_tokens = cached_tokens = 0
+            try:
+                with self._stage("request"), self._slot():
+                    response = self.backend.completion(**self._provider_request(request))
+                answers = self._parse_packed_response(response)
+                prompt_tokens, completion_tokens, cached_tokens = _usage_tokens(response)
+            except Exception:
+                answers = {}
+
+            latency = time.perf_counter() - start
+            for number, (position, question, single_request, cache_key) in enumerate(pending, 1):
+                specialists = answers.get(number)
+                if specialists is not None:
+                    results[position] = Recommendation(
+                        specialists,
+                        RecommendationStatus.OK,
+                        f"Specialists: {', '.join(specialists)}",
+                        request["model"],
+                        prompt_tokens // len(pending),
+                        completion_tokens // len(answers),
+                        latency,
+                        cached_tokens=cached_tokens // len(pending),
+                    )
+                    self._store(question, single_request, cache_key, results[position])
+
+        for result in results:
+            if result is not None:
+                self._finish(result)
+        for position, question, single_request, cache_key in pending:
+            if results[position] is None:
+                try:
+                    with self._stage("recommend"):
+                        results[position] = self._remote_recommend(
+                            question, single_request, cache_key, time.perf_counter())
+                except Exception as e:
+                    results[position] = Recommendation.failed(str(e), self.model)
+        return results
+
+    def submit(self, question, timeout=None):
+        """
+        Runs ``recommend(question)`` on the shared worker pool and returns a Future.
+
+        At most ``max_workers`` requests run at once and ``max_pending`` more
+        wait for a worker. With every slot taken, ``submit`` blocks for up to
+        ``timeout`` seconds (None waits indefinitely) and then raises
+        ``queue.Full``, so a burst of callers cannot open more provider
+        connections than the pool has workers.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            with self._pool_lock:
+                self.rejected += 1
+            raise queue.Full(f"{self.max_workers + self.max_pending} requests are already in flight")
+        try:
+            future = self._worker_pool().submit(self.recommend, question)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _worker_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix="medrefer-worker")
+            return self._pool
+
+    def close(self, wait=True):
+        """
+        Shuts down the ``submit`` and hedging pools; pending submissions still complete when ``wait``.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        with self._hedge_lock:
+            hedge_executor, self._hedge_executor = self._hedge_executor, None
+        for executor in (pool, hedge_executor):
+            if executor is not None:
+                executor.shutdown(wait=wait)
+
+    def get_specialist_recommendations(self, questions, max_concurrency=8, pack_size=1):
+        """
+        Determines the appropriate medical specialists for many questions concurrently.
+
+        At most ``max_concurrency`` requests are in flight at any time and the
+        input iterable is consumed lazily. Results are returned in input order;
+        a failure on one question is reported as an "Error: ..." string for that
+        item instead of failing the whole batch.
+
+        With ``pack_size`` > 1, up to that many questions share one completion
+        that repeats the instructions only once.
+        """
+        return list(self.iter_specialist_recommendations(questions, max_concurrency, pack_size))
+
+    def iter_specialist_recommendations(self, questions, max_concurrency=8, pack_size=1):
+        """
+        Lazily yields specialist recommendations for ``questions`` in input order.
+        """
+        for result in self.iter_recommendations(questions, max_concurrency, pack_size):
+            yield str(result)
+
+    def recommend_many(self, questions, max_concurrency=8, pack_size=1):
+        """
+        Like get_specialist_recommendations, but returns Recommendation objects.
+        """
+        return list(self.iter_recommendations(questions, max_concurrency, pack_size))
+
+    def iter_recommendations(self, questions, max_concurrency=8, pack_size=1):
+        """
+        Lazily yields a Recommendation for each of ``questions`` in input order.
+
+        With an AdaptiveConcurrency limiter, the limiter decides how many
+        requests are in flight, up to the lower of ``max_concurrency`` and its ``max_limit``.
+        """
+        max_concurrency = self._batch_concurrency(max_concurrency)
+        if pack_size < 1:
+            raise ValueError("pack_size must be at least 1")
+
+        if pack_size == 1:
+            work, tasks = self._recommend_safely, questions
+        else:
+            work, tasks = self._recommend_pack, _chunked(questions, pack_size)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(work, task))
+                # Keep a small backlog queued so workers never idle, but never
+                # materialize the whole input.
+                if len(pending) >= 2 * max_concurrency:
+                    yield from self._unpack(pending.popleft().result(), pack_size)
+            while pending:
+                yield from self._unpack(pending.popleft().result(), pack_size)
+
+    def iter_completed(self, questions, max_concurrency=8, pack_size=1):
+        """
+        Lazily yields ``(position, Recommendation)`` pairs in completion order.
+
+        Like iter_recommendations, but a slow request never holds back results
+        queued behind it; ``position`` is the question's index in ``questions``.
+        """
+        max_concurrency = self._batch_concurrency(max_concurrency)
+        if pack_size < 1:
+            raise ValueError("pack_size must be at least 1")
+
+        work = self._recommend_safely if pack_size == 1 else self._recommend_pack
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            in_flight = {}
+            for chunk in _chunked(enumerate(questions), pack_size):
+                positions, chunk_questions = zip(*chunk)
+                task = chunk_questions[0] if pack_size == 1 else list(chunk_questions)
+                in_flight[executor.submit(work, task)] = positions
+                if len(in_flight) >= 2 * max_concurrency:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from zip(in_flight.pop(future), self._unpack(future.result(), pack_size))
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from zip(in_flight.pop(future), self._unpack(future.result(), pack_size))
+
+    @staticmethod
+    def _unpack(result, pack_size):
+        return result if pack_size > 1 else (result,)
+
+    def _recommend_safely(self, question):
+        try:
+            return self.recommend(question)
+        except Exception as e:
+            return Recommendation.failed(str(e), self.model)
+
+
+def _sync_only(name, hint):
+    """
+    Returns a method that stops AsyncMedReferral callers reaching an inherited sync entry point.
+    """
+    def method(self, *args, **kwargs):
+        raise TypeError(f"AsyncMedReferral.{name} is not supported; {hint}")
+
+    method.__name__ = name
+    return method
+
+
+class AsyncMedReferral(MedReferral):
+    """
+    An asyncio variant of MedReferral that awaits the provider via litellm.acompletion.
+
+    Prompt building and specialist validation are inherited from MedReferral, so
+    the sync and async paths always send and accept the same things. Cancelling
+    the awaiting task cancels the in-flight request.
+
+    There is no ``submit`` worker pool: ``submit`` raises TypeError, and callers
+    wrap ``recommend`` in ``asyncio.create_task`` instead. The other sync-only
+    entry points (``iter_completed``, packed requests and wrapping in a
+    ReferralService) raise TypeError too, rather than returning coroutines that
+    are never awaited. The batch methods take ``timeout`` as a keyword, so a
+    positional ``pack_size`` meant for MedReferral fails loudly as well.
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    submit = _sync_only("submit", "use asyncio.create_task(referral.recommend(question))")
+    iter_completed = _sync_only("iter_completed", "use asyncio.as_completed over recommend() tasks")
+    _recommend_pack = _sync_only("_recommend_pack", "packed requests need the sync MedReferral")
+    _recommend_safely = _sync_only("_recommend_safely", "batch paths need the sync MedReferral")
+
+    async def get_specialist_recommendation(self, question, timeout=None):
+        """
+        Determines the appropriate medical specialists for a given question.
+
+        ``timeout`` (seconds) overrides the instance default for this call only.
+        """
+        return str(await self.recommend(question, timeout))
+
+    async def recommend(self, question, timeout=None):
+        """
+        Determines the appropriate medical specialists for a given question as a Recommendation.
+        """
+        with self._stage("recommend"):
+            start = time.perf_counter()
+            timeout = self.timeout if timeout is None else timeout
+            with self._stage("prompt"):
+                request = self._completion_kwargs(question)
+            with self._stage("lookup"):
+                cache_key, local_answer = self._local_answer(question, request)
+            if local_answer is not None:
+                local_answer.latency = time.perf_counter() - start
+                return self._finish(local_answer)
+
+            try:
+                result = await asyncio.wait_for(self._arequest_chain(request), timeout)
+
+            except asyncio.TimeoutError:
+                return self._finish(Recommendation.failed(f"Request timed out after {timeout} seconds",
+                                                          request["model"], time.perf_counter() - start))
+
+            if not result.prompt_tokens and result.status is not RecommendationStatus.ERROR:
+                # Streams and some providers report no usage; fall back to an estimate
+                result.prompt_tokens = self.prompt.estimate_tokens(question)
+            result.latency = time.perf_counter() - start
+            self._store(question, request, cache_key, result)
+            return self._finish(result)
+
+    async def _arequest_chain(self, request):
+        models = self.models
+        result = None
+        if self.hedge_percentile is not None and len(models) > 1:
+            result = await self._ahedged_attempt(request, models[0], models[1])
+            models = models[2:]
+
+        for model in models:
+            if result is not None and result.status is RecommendationStatus.OK:
+                break
+            if result is not None:
+                self._count_fallback()
+            attempt = await self._aattempt(dict(request, model=model))
+            # Never let an error replace an answer from an earlier model
+            if (result is None or result.status is RecommendationStatus.ERROR
+                    or attempt.status is not RecommendationStatus.ERROR):
+                result = attempt
+        return result
+
+    async def _ahedged_attempt(self, request, primary, secondary):
+        """
+        Like MedReferral._hedged_attempt, but the losing request is cancelled.
+        """
+        tasks = [asyncio.ensure_future(self._aattempt(dict(request, model=primary)))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_deadline())
+            if done and tasks[0].result().status is RecommendationStatus.OK:
+                return tasks[0].result()
+
+            if done:
+                self._count_fallback()
             else:
-                return f"{specialists} (Note: Please verify with a healthcare professional.)"
+                with self._hedge_lock:
+                    self.hedged += 1
+            tasks.append(asyncio.ensure_future(self._aattempt(dict(request, model=secondary))))
+
+            results = []
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result().status is RecommendationStatus.OK:
+                        return task.result()
+                    results.append(task.result())
+            results.sort(key=lambda result: result.status is RecommendationStatus.ERROR)
+            return results[0]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _aattempt(self, request):
+        start = time.perf_counter()
+        try:
+            async with self._slot():
+                result = await self._arequest(request)
+        except Exception as e:
+            return Recommendation.failed(str(e), request["model"])
+
+        if request["model"] == self.models[0]:
+            self._record_primary_latency(time.perf_counter() - start)
+        return result
+
+    async def _arequest(self, request):
+        if not self.stream:
+            with self._stage("request"):
+                response = await self.backend.acompletion(**self._provider_request(request))
+            return self._parse_response(response, request["model"])
+
+        scanner = SpecialistLineScanner()
+        with self._stage("request"):
+            stream = await self.backend.acompletion(**self._provider_request(request), stream=True)
+            try:
+                async for chunk in stream:
+                    if scanner.feed(_chunk_text(chunk)):
+                        break
+            finally:
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+        return self._parse_text(scanner.text, request["model"])
+
+    async def get_specialist_recommendations(self, questions, max_concurrency=8, *, timeout=None):
+        """
+        Determines the appropriate medical specialists for many questions concurrently.
+
+        Results are returned in input order and errors are reported per item.
+        """
+        return [result async for result in
+                self.iter_specialist_recommendations(questions, max_concurrency, timeout=timeout)]
+
+    async def iter_specialist_recommendations(self, questions, max_concurrency=8, *, timeout=None):
+        """
+        Lazily yields specialist recommendations for ``questions`` in input order.
+        """
+        async for result in self.iter_recommendations(questions, max_concurrency, timeout=timeout):
+            yield str(result)
+
+    async def recommend_many(self, questions, max_concurrency=8, *, timeout=None):
+        """
+        Like get_specialist_recommendations, but returns Recommendation objects.
+        """
+        return [result async for result in
+                self.iter_recommendations(questions, max_concurrency, timeout=timeout)]
+
+    async def iter_recommendations(self, questions, max_concurrency=8, *, timeout=None):
+        """
+        Lazily yields a Recommendation for each of ``questions`` in input order.
+
+        With an AdaptiveConcurrency limiter, ``max_concurrency`` still caps the requests in flight.
+        """
+        max_concurrency = self._batch_concurrency(max_concurrency)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(question):
+            async with semaphore:
+                return await self.recommend(question, timeout)
+
+        pending = deque()
+        try:
+            for question in questions:
+                pending.append(asyncio.ensure_future(run(question)))
+                if len(pending) >= 2 * max_concurrency:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # Abandoned or cancelled iteration must not leak requests
+            for task in pending:
+                task.cancel()
+
+
+class ReferralService:
+    """
+    Serves recommendations to many concurrent callers through one MedReferral.
+
+    Identical in-flight questions (after normalization) are coalesced into a
+    single request. Distinct questions arriving within ``batch_window``
+    seconds of each other are gathered into micro-batches of up to
+    ``max_batch`` questions and sent as one packed completion; set
+    ``max_batch=1`` to send every question on its own. All batches share the
+    referral's backend, and so the provider's pooled HTTP connections.
+
+    Packed completions go to the primary model as numbered text, so batching
+    is turned off (``max_batch`` becomes 1) for a referral with a fallback
+    chain, hedging or JSON output; each question then goes through
+    ``referral.recommend`` with its full configuration.
+    """
+
+    def __init__(self, referral, batch_window=0.005, max_batch=8, max_concurrency=16):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        if isinstance(referral, AsyncMedReferral):
+            raise TypeError("ReferralService needs a sync MedReferral")
+        self.referral = referral
+        self.batch_window = batch_window
+        self.max_batch = max_batch if self._can_pack(referral) else 1
+        self.requests = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.batched_questions = 0
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._collector = threading.Thread(target=self._collect, name="medrefer-batcher", daemon=True)
+        self._collector.start()
+
+    def submit(self, question):
+        """
+        Queues ``question`` and returns a Future for its Recommendation.
+        """
+        key = normalize_question(question)
+        with self._lock:
+            self.requests += 1
+            future = self._pending.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._pending[key] = Future()
+        self._queue.put((key, question, future))
+        return future
+
+    def recommend(self, question, timeout=None):
+        """
+        Returns the Recommendation for ``question``, waiting at most ``timeout`` seconds.
+        """
+        start = time.perf_counter()
+        result = self.submit(question).result(timeout)
+        with self._lock:
+            self._latencies.append(time.perf_counter() - start)
+        return result
+
+    def recommend_many(self, questions, timeout=None):
+        """
+        Returns Recommendations for ``questions`` in order; they are batched with all other callers.
+        """
+        start = time.perf_counter()
+        futures = [self.submit(question) for question in questions]
+        results = [future.result(timeout) for future in futures]
+        with self._lock:
+            self._latencies.extend([time.perf_counter() - start] * len(results))
+        return results
+
+    def _collect(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Stop after dispatching what was already gathered
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            with self._lock:
+                self.batches += 1
+                self.batched_questions += len(batch)
+            self._executor.submit(self._run_batch, batch)
+
+    @staticmethod
+    def _can_pack(referral):
+        return (len(referral.models) == 1 and referral.hedge_percentile is None
+                and referral.prompt.output == "text")
 
+    def _run_batch(self, batch):
+        questions = [question for _, question, _ in batch]
+        try:
+            if len(questions) == 1:
+                results = [self.referral.recommend(questions[0])]
+            else:
+                results = self.referral._recommend_pack(questions)
         except Exception as e:
-            return f"Error: {str(e)}"
+            results = [Recommendation.failed(str(e), self.referral.model)] * len(batch)
+        for (key, _, future), result in zip(batch, results):
+            with self._lock:
+                del self._pending[key]
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                "requests": self.requests,
+                "coalesced": self.coalesced,
+                "queue_depth": self._queue.qsize(),
+                "in_flight": len(self._pending),
+                "batches": self.batches,
+                "mean_batch_size": self.batched_questions / self.batches if self.batches else 0.0,
+            }
+        for percent in (50, 95, 99):
+            stats[f"p{percent}_latency_s"] = _nearest_rank(latencies, percent) if latencies else 0.0
+        return stats
+
+    def close(self):
+        """
+        Stops the batcher after in-flight batches finish.
+        """
+        self._queue.put(None)
+        self._collector.join()
+        self._executor.shutdown(wait=True)
+
+
+class _ReferralRequestHandler:
+    # Mixed into http.server.BaseHTTPRequestHandler by make_server
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send(200, self.server.service.stats())
+        elif self.path == "/metrics/prometheus":
+            metrics = self.server.service.referral.metrics
+            if metrics is None:
+                self._send(404, {"error": "Metrics are not enabled"})
+            else:
+                self._send(200, metrics.prometheus(), "text/plain; version=0.0.4")
+        else:
+            self._send(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/recommend":
+                question = body["question"]
+                if not isinstance(question, str):
+                    raise TypeError("question must be a string")
+                self._send(200, self.server.service.recommend(question).to_dict())
+            elif self.path == "/recommend/batch":
+                questions = body["questions"]
+                if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+                    raise TypeError("questions must be a list of strings")
+                results = self.server.service.recommend_many(questions)
+                self._send(200, {"results": [result.to_dict() for result in results]})
+            else:
+                self._send(404, {"error": f"Unknown path: {self.path}"})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {"error": f"Bad request: {e}"})
+
+    def _send(self, status, payload, content_type="application/json"):
+        body = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Per-request access logging to stderr would dominate at high request rates
+        pass
+
+
+def make_server(service, host="127.0.0.1", port=8000):
+    """
+    Returns a threading HTTP server exposing ``service``.
+
+    Endpoints: ``POST /recommend`` with ``{"question": ...}``, ``POST
+    /recommend/batch`` with ``{"questions": [...]}``, ``GET /metrics``,
+    ``GET /metrics/prometheus`` (when the referral has Metrics) and ``GET
+    /health``. Responses are Recommendation dicts.
+    """
+    handler = type("ReferralRequestHandler", (_ReferralRequestHandler, http_server.BaseHTTPRequestHandler), {})
+    server = http_server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def read_questions(path, field="question", input_format=None):
+    """
+    Lazily yields ``(index, question)`` pairs from a JSONL or CSV file, or stdin for "-".
+
+    JSONL lines may be plain JSON strings or objects holding the question under
+    ``field``; CSV files need a header row with a ``field`` column. The format
+    follows the file extension unless ``input_format`` is given.
+    """
+    if input_format is None:
+        input_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    f = sys.stdin if path == "-" else open(path, newline="" if input_format == "csv" else None)
+    try:
+        if input_format == "csv":
+            reader = csv.DictReader(f)
+            if reader.fieldnames is None or field not in reader.fieldnames:
+                raise ValueError(f"{path} has no {field!r} column")
+            for index, row in enumerate(reader):
+                yield index, row[field]
+            return
+
+        index = 0
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                if field not in record:
+                    raise ValueError(f"{path}:{line_number} has no {field!r} field")
+                record = record[field]
+            yield index, str(record)
+            index += 1
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def load_checkpoint(path):
+    """
+    Returns the input indices already answered in a batch output file.
+
+    A partial last line left by an interrupted run is cut off, and items that
+    ended in an error are not counted, so they are retried on resume.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+
+    done = set()
+    for line in data[:end].splitlines():
+        record = json.loads(line)
+        if record["status"] == RecommendationStatus.ERROR.value:
+            done.discard(record["index"])
+        else:
+            done.add(record["index"])
+    return done
+
+
+def run_batch(referral, input_path, output_path, concurrency=8, pack_size=1, field="question",
+              input_format=None):
+    """
+    Routes every question in ``input_path`` and appends results to ``output_path`` as they finish.
+
+    Each output line is a Recommendation dict tagged with the input ``index``
+    and ``question``. The output file doubles as the checkpoint: questions it
+    already answers are skipped, and the last line for an index wins.
+    Returns counts of written, skipped and failed items.
+    """
+    done = load_checkpoint(output_path)
+    counts = {"written": 0, "skipped": 0, "errors": 0}
+    # Maps positions in the pending stream back to input indices, for in-flight items only
+    in_flight = {}
+    positions = itertools.count()
+
+    def pending():
+        for index, question in read_questions(input_path, field, input_format):
+            if index in done:
+                counts["skipped"] += 1
+                continue
+            in_flight[next(positions)] = (index, question)
+            yield question
+
+    with open(output_path, "a", buffering=1) as out:
+        for position, result in referral.iter_completed(pending(), concurrency, pack_size):
+            index, question = in_flight.pop(position)
+            out.write(json.dumps({"index": index, "question": question, **result.to_dict()}) + "\n")
+            counts["written"] += 1
+            counts["errors"] += result.status is RecommendationStatus.ERROR
+    return counts
+
+
+def _serve(args):
+    backend = CassetteBackend(args.cassette) if args.cassette else None
+    referral = MedReferral(backend=backend, model=args.model, metrics=Metrics())
+    service = ReferralService(referral, args.batch_window, args.max_batch, args.concurrency)
+    server = make_server(service, args.host, args.port)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend medical specialists for questions.")
+    commands = parser.add_subparsers(dest="command")
+    batch = commands.add_parser("batch", help="Route a JSONL or CSV file of questions")
+    batch.add_argument("--in", dest="input", required=True, help='JSONL or CSV questions, or "-" for stdin')
+    batch.add_argument("--out", required=True, help="JSONL results file, also used to resume")
+    batch.add_argument("--concurrency", type=int, default=8, help="Requests in flight (the ceiling with --adaptive)")
+    batch.add_argument("--adaptive", action="store_true",
+                       help="Adapt requests in flight to provider latency and 429s, up to --concurrency")
+    batch.add_argument("--pack-size", type=int, default=1, help="Questions per packed completion")
+    batch.add_argument("--field", default="question", help="JSONL field or CSV column holding the question")
+    batch.add_argument("--format", choices=("jsonl", "csv"), help="Input format (default: by extension)")
+    batch.add_argument("--model", nargs="+", default=["gemini-2.5-flash"], help="LiteLLM model or fallback chain")
+    serve = commands.add_parser("serve", help="Run the HTTP referral service")
+    serve.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    serve.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    serve.add_argument("--batch-window", type=float, default=0.005, help="Seconds to gather a micro-batch")
+    serve.add_argument("--max-batch", type=int, default=8, help="Questions per micro-batch (1 disables batching)")
+    serve.add_argument("--concurrency", type=int, default=16, help="Batches in flight")
+    serve.add_argument("--model", nargs="+", default=["gemini-2.5-flash"], help="LiteLLM model or fallback chain")
+    serve.add_argument("--cassette", help="Replay recorded answers from this cassette instead of a provider")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        return _serve(args)
+
+    if args.command is None:
+        med_referral = MedReferral()
+        while True:
+            medical_question = input("Enter your medical question: ")
+            specialists = med_referral.get_specialist_recommendation(medical_question)
+            print(f"Recommended Specialists: {specialists}")
+
+    try:
+        concurrency = None
+        if args.adaptive:
+            concurrency = AdaptiveConcurrency(initial=min(8, args.concurrency), max_limit=args.concurrency)
+        counts = run_batch(MedReferral(model=args.model, concurrency=concurrency), args.input, args.out,
+                           args.concurrency, args.pack_size, args.field, args.format)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    print(f"Wrote {counts['written']} results ({counts['errors']} errors), "
+          f"skipped {counts['skipped']} already answered", file=sys.stderr)
+
 
 # Example usage
 if __name__ == "__main__":
-    med_referral = MedReferral()
-    while True:
-        medical_question = input("Enter your medical question: ")
-        specialists = med_referral.get_specialist_recommendation(medical_question)
-        print(f"Recommended Specialists: {specialists}")
-
+    main()
@@ -0,0 +1,81 @@
+"""
+Tests for the MedRefer benchmark harness.
+"""
+
+import json
+
+from bench import FakeBackend, _summarize, main, measure_startup, run_benchmark, run_scenario
+from medrefer import MedReferral
+
+
+class TestFakeBackend:
+    """Test the mock LLM backend used by the benchmarks."""
+
+    def test_answers_known_questions_with_their_label(self):
+        """Test that example questions route to their labeled specialist."""
+        referral = MedReferral(backend=FakeBackend())
+        result = referral.get_specialist_recommendation("Who performs heart bypass surgery?")
+
+        assert result == "Cardiothoracic Surgeon"
+
+    def test_answers_packed_prompts_per_question(self):
+        """Test that packed prompts receive one numbered answer per question."""
+        backend = FakeBackend()
+        referral = MedReferral(backend=backend)
+        results = referral.get_specialist_recommendations(
+            ["Who performs heart bypass surgery?", "Who should I see for a dust mite allergy?"],
+            pack_size=2,
+        )
+
+        assert results == ["Cardiothoracic Surgeon", "Allergist"]
+        assert backend.calls == 1
+
+
+class TestRunBenchmark:
+    """Test the benchmark report."""
+
+    def test_report_covers_all_scenarios(self):
+        """Test that every scenario reports throughput and latency percentiles."""
+        report = run_benchmark(allocations=False, startup=False)
+
+        assert set(report["scenarios"]) == {"sync", "batch", "cached"}
+        for result in report["scenarios"].values():
+            assert result["items"] == report["config"]["questions"]
+            assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+        assert report["scenarios"]["cached"]["llm_calls"] == 0
+
+    def test_batch_items_are_timed_individually(self):
+        """Test that batch latencies measure each item instead of repeating the mean."""
+        questions = [f"question {n}" for n in range(8)]
+        latencies, elapsed = run_scenario("batch", questions, FakeBackend(latency=0.01), concurrency=2)
+
+        assert len(latencies) == len(questions)
+        assert latencies == sorted(latencies)
+        assert latencies[0] < latencies[-1] <= elapsed
+
+    def test_percentiles_use_nearest_rank(self):
+        """Test that bench percentiles match the service and evaluation reports."""
+        summary = _summarize([0.1 * n for n in range(1, 11)], 1.0)
+
+        assert summary["p50_ms"] == 500
+        assert round(summary["p95_ms"]) == 1000
+
+    def test_cli_writes_json_report(self, tmp_path):
+        """Test that the CLI writes a machine-readable report."""
+        output = tmp_path / "run.json"
+        main(["--scenarios", "cached", "--no-startup", "--output", str(output)])
+
+        report = json.loads(output.read_text())
+        assert "alloc_peak_kib" in report["scenarios"]["cached"]
+
+
+class TestStartup:
+    """Test the cold-start benchmark."""
+
+    def test_cached_answer_does_not_import_litellm(self):
+        """Test that a fresh process answers from cache without the provider SDK."""
+        startup = measure_startup(repeat=1)
+
+        assert startup["answered_from"] == "cache"
+        assert startup["litellm_imported"] is False
+        assert startup["import_ms"] <= startup["first_cached_answer_ms"]
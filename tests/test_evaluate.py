@@ -0,0 +1,48 @@
+"""
+Tests for the MedRefer evaluation runner.
+"""
+
+from bench import FakeBackend
+from evaluate import run_evaluation, score
+
+
+class TestScore:
+    """Test precision, recall and confusion matrix computation."""
+
+    def test_precision_recall_and_confusion(self):
+        """Test scoring over a hand-built set of predictions."""
+        items = [
+            {"label": "Cardiologist", "predicted": ["Cardiologist", "Pulmonologist"]},
+            {"label": "Cardiologist", "predicted": []},
+            {"label": "Pulmonologist", "predicted": ["Cardiologist"]},
+        ]
+
+        per_specialist, confusion = score(items, {"Cardiologist", "Pulmonologist"})
+
+        assert per_specialist["Cardiologist"]["precision"] == 0.5
+        assert per_specialist["Cardiologist"]["recall"] == 0.5
+        assert per_specialist["Pulmonologist"]["precision"] == 0.0
+        assert per_specialist["Pulmonologist"]["recall"] == 0.0
+        assert confusion["Cardiologist"] == {"Cardiologist": 1, "Pulmonologist": 1, "(none)": 1}
+        assert confusion["Pulmonologist"] == {"Cardiologist": 1}
+
+
+class TestRunEvaluation:
+    """Test the end-to-end evaluation report."""
+
+    def test_perfect_backend_scores_full_accuracy(self):
+        """Test that a backend answering with the labels scores 100%."""
+        report = run_evaluation(model="fake", workers=4, backend=FakeBackend())
+
+        summary = report["summary"]
+        assert summary["items"] == 225
+        assert summary["accuracy"] == 1.0
+        assert summary["macro_recall"] == 1.0
+        assert summary["prompt_tokens"] > 0
+        assert all(item["latency_s"] >= 0 for item in report["items"])
+
+    def test_limit_restricts_examples(self):
+        """Test that --limit evaluates only the first N examples."""
+        report = run_evaluation(model="fake", backend=FakeBackend(), limit=5)
+
+        assert report["summary"]["items"] == 5
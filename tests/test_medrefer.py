@@ -2,9 +2,49 @@
 Tests for the MedRefer medical specialist recommendation system.
 """
 
+import asyncio
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-from medrefer import MedReferral
+from unittest.mock import AsyncMock, Mock, patch, MagicMock
+from medrefer import (
+    AdaptiveConcurrency,
+    AsyncMedReferral,
+    CassetteBackend,
+    CassetteMissError,
+    CircuitBreaker,
+    CircuitOpenError,
+    DEFAULT_FEW_SHOT,
+    LLMClient,
+    LRUCache,
+    MedReferral,
+    Metrics,
+    PromptTemplate,
+    Recommendation,
+    RecommendationStatus,
+    ReferralService,
+    ResilientBackend,
+    RetryPolicy,
+    SPECIALIST_ALIASES,
+    SemanticCache,
+    SpecialistClassifier,
+    SpecialistMatcher,
+    SQLiteCache,
+    TokenBucket,
+    load_checkpoint,
+    main,
+    make_server,
+    read_questions,
+    run_batch,
+)
 
 
 class TestMedReferralInit:
@@ -293,3 +333,1859 @@ class TestMedReferralIntegration:
         # Psychologist is not in the valid list, so only Psychiatrist should remain
         assert "Psychiatrist" in result
         assert "Psychologist" not in result
+
+
+def _raise(error):
+    raise error
+
+
+def _mock_response(content):
+    response = Mock()
+    response.choices = [Mock()]
+    response.choices[0].message.content = content
+    return response
+
+
+class TestGetSpecialistRecommendations:
+    """Test the batch get_specialist_recommendations method."""
+
+    @patch('litellm.completion')
+    def test_results_preserve_input_order(self, mock_completion):
+        """Test that batch results line up with the input questions."""
+        answers = {
+            "itchy skin rash": "Specialists: Dermatologist",
+            "racing heartbeat": "Specialists: Cardiologist",
+            "red watery eyes": "Specialists: Ophthalmologist",
+        }
+
+        def fake_completion(**kwargs):
+            content = kwargs['messages'][1]['content']
+            for question, answer in answers.items():
+                if question in content:
+                    return _mock_response(answer)
+
+        mock_completion.side_effect = fake_completion
+
+        referral = MedReferral()
+        questions = ["itchy skin rash", "racing heartbeat", "red watery eyes"] * 10
+        results = referral.get_specialist_recommendations(questions, max_concurrency=4)
+
+        assert results == [answers[q].split(": ")[1] for q in questions]
+
+    @patch('litellm.completion')
+    def test_errors_are_reported_per_item(self, mock_completion):
+        """Test that one failing question does not fail the whole batch."""
+        def fake_completion(**kwargs):
+            if "bad" in kwargs['messages'][1]['content']:
+                raise Exception("API Connection Error")
+            return _mock_response("Specialists: Neurologist")
+
+        mock_completion.side_effect = fake_completion
+
+        referral = MedReferral()
+        results = referral.get_specialist_recommendations(["good", "bad", "good"])
+
+        assert results[0] == "Neurologist"
+        assert results[1] == "Error: API Connection Error"
+        assert results[2] == "Neurologist"
+
+    @patch('litellm.completion')
+    def test_concurrency_is_bounded(self, mock_completion):
+        """Test that no more than max_concurrency requests are in flight."""
+        import threading
+        import time
+
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def fake_completion(**kwargs):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            return _mock_response("Specialists: Urologist")
+
+        mock_completion.side_effect = fake_completion
+
+        referral = MedReferral()
+        results = referral.get_specialist_recommendations(
+            (f"question {i}" for i in range(20)), max_concurrency=3
+        )
+
+        assert len(results) == 20
+        assert 1 < state['peak'] <= 3
+
+    def test_invalid_concurrency_raises(self):
+        """Test that a non-positive concurrency cap is rejected."""
+        referral = MedReferral()
+        with pytest.raises(ValueError):
+            referral.get_specialist_recommendations(["q"], max_concurrency=0)
+
+
+class TestAsyncMedReferral:
+    """Test the asyncio AsyncMedReferral variant."""
+
+    @patch('litellm.acompletion', new_callable=AsyncMock)
+    def test_async_recommendation_returns_valid_specialists(self, mock_acompletion):
+        """Test that the async path parses and validates like the sync path."""
+        mock_acompletion.return_value = _mock_response(
+            "Specialists: Cardiologist, InvalidSpecialist, Pulmonologist"
+        )
+
+        referral = AsyncMedReferral()
+        result = asyncio.run(referral.get_specialist_recommendation("I have chest pain"))
+
+        assert result == "Cardiologist, Pulmonologist"
+
+    @patch('litellm.completion')
+    @patch('litellm.acompletion', new_callable=AsyncMock)
+    def test_async_and_sync_send_identical_requests(self, mock_acompletion, mock_completion):
+        """Test that both paths share prompt building."""
+        mock_acompletion.return_value = _mock_response("Specialists: Dermatologist")
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+
+        asyncio.run(AsyncMedReferral().get_specialist_recommendation("I have a rash"))
+        MedReferral().get_specialist_recommendation("I have a rash")
+
+        assert mock_acompletion.call_args.kwargs == mock_completion.call_args.kwargs
+
+    @patch('litellm.acompletion')
+    def test_async_per_call_timeout(self, mock_acompletion):
+        """Test that a slow provider call is reported as a timeout error."""
+        async def slow_completion(**kwargs):
+            await asyncio.sleep(10)
+
+        mock_acompletion.side_effect = slow_completion
+
+        referral = AsyncMedReferral(timeout=10)
+        result = asyncio.run(referral.get_specialist_recommendation("I have a headache", timeout=0.01))
+
+        assert result.startswith("Error:")
+        assert "timed out" in result
+
+    @patch('litellm.acompletion')
+    def test_async_cancellation_propagates(self, mock_acompletion):
+        """Test that cancelling the caller cancels the request instead of returning an error."""
+        async def slow_completion(**kwargs):
+            await asyncio.sleep(10)
+
+        mock_acompletion.side_effect = slow_completion
+
+        async def cancel_call():
+            task = asyncio.ensure_future(AsyncMedReferral().get_specialist_recommendation("q"))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            return await task
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(cancel_call())
+
+    @patch('litellm.acompletion')
+    def test_async_batch_preserves_order_and_reports_errors(self, mock_acompletion):
+        """Test that the async batch keeps input order and isolates failures."""
+        async def fake_acompletion(**kwargs):
+            content = kwargs['messages'][1]['content']
+            if "bad" in content:
+                raise Exception("API Connection Error")
+            await asyncio.sleep(0.001)
+            return _mock_response("Specialists: Nephrologist")
+
+        mock_acompletion.side_effect = fake_acompletion
+
+        referral = AsyncMedReferral()
+        results = asyncio.run(
+            referral.get_specialist_recommendations(["good", "bad", "good"], max_concurrency=2)
+        )
+
+        assert results == ["Nephrologist", "Error: API Connection Error", "Nephrologist"]
+
+    def test_async_rejects_inherited_sync_entry_points(self):
+        """Test that sync-only entry points fail loudly instead of yielding unawaited coroutines."""
+        referral = AsyncMedReferral()
+
+        with pytest.raises(TypeError, match="iter_completed"):
+            list(referral.iter_completed(["q"]))
+        with pytest.raises(TypeError, match="_recommend_pack"):
+            referral._recommend_pack(["q1", "q2"])
+        with pytest.raises(TypeError, match="_recommend_safely"):
+            referral._recommend_safely("q")
+
+    def test_async_batch_rejects_positional_pack_size(self):
+        """Test that a MedReferral-style positional pack_size is not taken as a timeout."""
+        referral = AsyncMedReferral()
+
+        with pytest.raises(TypeError):
+            asyncio.run(referral.recommend_many(["q"], 8, 10))
+        with pytest.raises(TypeError):
+            asyncio.run(referral.recommend_many(["q"], pack_size=10))
+
+
+class TestResponseCache:
+    """Test the recommendation cache backends and their use by MedReferral."""
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        """Test that the LRU cache keeps at most max_entries entries."""
+        cache = LRUCache(max_entries=2)
+        cache.set("a", "Cardiologist")
+        cache.set("b", "Neurologist")
+        cache.get("a")
+        cache.set("c", "Dermatologist")
+
+        assert cache.get("a") == "Cardiologist"
+        assert cache.get("b") is None
+        assert cache.get("c") == "Dermatologist"
+        assert len(cache) == 2
+
+    def test_lru_cache_expires_entries(self):
+        """Test that entries older than the TTL are not returned."""
+        cache = LRUCache(ttl=-1)
+        cache.set("a", "Cardiologist")
+
+        assert cache.get("a") is None
+
+    def test_cache_counts_hits_and_misses(self):
+        """Test the hit/miss counters."""
+        cache = LRUCache()
+        cache.get("a")
+        cache.set("a", "Cardiologist")
+        cache.get("a")
+
+        assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "size": 1}
+
+    def test_sqlite_cache_persists_and_evicts(self, tmp_path):
+        """Test that the SQLite cache survives reopening and honours max_entries."""
+        path = str(tmp_path / "cache.db")
+        cache = SQLiteCache(path, max_entries=2)
+        cache.set("a", "Cardiologist")
+        cache.set("b", "Neurologist")
+        cache.set("c", "Dermatologist")
+        cache.close()
+
+        reopened = SQLiteCache(path, max_entries=2)
+        assert len(reopened) == 2
+        assert reopened.get("a") is None
+        assert reopened.get("c") == "Dermatologist"
+        reopened.close()
+
+    def test_sqlite_hits_do_not_write_until_the_next_set(self, tmp_path):
+        """Test that hits are buffered and still decide which entry is evicted."""
+        cache = SQLiteCache(str(tmp_path / "cache.db"), max_entries=2)
+        cache.set("a", "Cardiologist")
+        cache.set("b", "Neurologist")
+        changes = cache._conn.total_changes
+
+        for _ in range(10):
+            assert cache.get("a") == "Cardiologist"
+        assert cache._conn.total_changes == changes
+
+        cache.set("c", "Dermatologist")
+        assert cache.get("a") == "Cardiologist"
+        assert cache.get("b") is None
+        cache.close()
+
+    @patch('litellm.completion')
+    def test_cache_hit_skips_llm_for_normalized_question(self, mock_completion):
+        """Test that questions differing in case and whitespace share a cache entry."""
+        mock_completion.return_value = _mock_response("Specialists: Cardiologist")
+
+        referral = MedReferral(cache=LRUCache())
+        first = referral.get_specialist_recommendation("I have chest pain")
+        second = referral.get_specialist_recommendation("  i HAVE   chest pain ")
+
+        assert first == second == "Cardiologist"
+        mock_completion.assert_called_once()
+        assert referral.cache.stats()["hits"] == 1
+
+    @patch('litellm.completion')
+    def test_errors_are_not_cached(self, mock_completion):
+        """Test that failed requests are retried rather than served from cache."""
+        mock_completion.side_effect = [Exception("API Connection Error"),
+                                       _mock_response("Specialists: Cardiologist")]
+
+        referral = MedReferral(cache=LRUCache())
+
+        assert referral.get_specialist_recommendation("I have chest pain").startswith("Error:")
+        assert referral.get_specialist_recommendation("I have chest pain") == "Cardiologist"
+
+    @patch('litellm.acompletion', new_callable=AsyncMock)
+    def test_async_path_uses_cache(self, mock_acompletion):
+        """Test that AsyncMedReferral reads and writes the same cache."""
+        mock_acompletion.return_value = _mock_response("Specialists: Cardiologist")
+
+        referral = AsyncMedReferral(cache=LRUCache())
+        asyncio.run(referral.get_specialist_recommendation("I have chest pain"))
+        asyncio.run(referral.get_specialist_recommendation("I have chest pain"))
+
+        mock_acompletion.assert_called_once()
+
+
+class TestSemanticCache:
+    """Test the near-duplicate semantic cache."""
+
+    def test_reworded_question_hits_and_unrelated_question_misses(self):
+        """Test that reordered and inflected questions reuse an answer and different ones do not."""
+        cache = SemanticCache()
+        cache.set("my chest hurts when I walk", "cardiology")
+
+        assert cache.get("When I walk, my chest hurts!") == "cardiology"
+        assert cache.get("my knee hurts when I walk") is None
+        assert cache.stats()["hits"] == 1
+
+    def test_different_body_parts_never_match(self):
+        """Test that near-identical wording about a different organ misses even at a low threshold."""
+        cache = SemanticCache(threshold=0.5)
+        cache.set("pain in my left eye", "ophthalmology")
+
+        assert cache.get("pain in my left ear") is None
+        assert cache.get("pain in my left eye") == "ophthalmology"
+
+    def test_negation_never_matches(self):
+        """Test that a negated question does not reuse the answer for the positive one."""
+        cache = SemanticCache(threshold=0.5)
+        cache.set("I have chest pain", "cardiology")
+
+        assert cache.get("I have no chest pain") is None
+        assert cache.get("I have no chest pain but have back pain") is None
+
+    def test_different_patients_never_match(self):
+        """Test that a question about a baby or child does not reuse the adult answer."""
+        cache = SemanticCache()
+        cache.set("I have chest pain", "cardiology")
+
+        assert cache.get("My baby has chest pain") is None
+        assert cache.get("My son has chest pain") is None
+        assert cache.get("I am pregnant and have chest pain") is None
+        assert cache.get("I have chest pains") == "cardiology"
+
+    def test_synonym_paraphrase_is_not_caught(self):
+        """Test the documented limit: synonyms without shared words miss at the default threshold."""
+        cache = SemanticCache()
+        cache.set("my chest hurts when I walk", "cardiology")
+
+        assert cache.get("chest pain while walking") is None
+
+    def test_namespaces_are_isolated(self):
+        """Test that answers are not shared across models or prompts."""
+        cache = SemanticCache()
+        cache.set("itchy rash on my arm", "a", namespace="model-a")
+
+        assert cache.get("itchy rash on my arm", namespace="model-b") is None
+        assert cache.get("itchy rash on my arm", namespace="model-a") == "a"
+
+    def test_bounded_size_evicts_least_recently_used(self):
+        """Test that a full index overwrites the least recently used entry."""
+        cache = SemanticCache(max_entries=2)
+        cache.set("itchy rash", "skin")
+        cache.set("blurry vision", "eyes")
+        cache.get("itchy rash")
+        cache.set("swollen knee", "joints")
+
+        assert len(cache) == 2
+        assert cache.get("itchy rash") == "skin"
+        assert cache.get("blurry vision") is None
+
+    def test_near_identical_question_replaces_entry(self):
+        """Test that re-inserting the same question does not use another slot."""
+        cache = SemanticCache()
+        cache.set("Itchy rash!", "old")
+        cache.set("itchy rash", "new")
+
+        assert len(cache) == 1
+        assert cache.get("itchy rashes") == "new"
+
+    def test_memory_mapped_index_persists(self, tmp_path):
+        """Test that a flushed memory-mapped index is reloaded."""
+        path = str(tmp_path / "semantic.idx")
+        cache = SemanticCache(path, max_entries=8)
+        cache.set("itchy rash on my arm", "skin")
+        cache.close()
+
+        reopened = SemanticCache(path, max_entries=8)
+        assert reopened.get("Itchy rash on my arm?") == "skin"
+        with pytest.raises(ValueError):
+            SemanticCache(path, max_entries=16)
+
+    @patch('litellm.completion')
+    def test_paraphrase_skips_llm(self, mock_completion):
+        """Test that MedReferral answers a paraphrase from the semantic cache."""
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        referral = MedReferral(semantic_cache=SemanticCache())
+
+        first = referral.recommend("I have an itchy rash on my arm")
+        second = referral.recommend("itchy rashes on arms")
+
+        assert mock_completion.call_count == 1
+        assert second.source == "semantic_cache"
+        assert second.specialists == first.specialists
+        assert second.prompt_tokens == 0
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return SpecialistClassifier.from_examples()
+
+
+class TestSpecialistClassifier:
+    """Test the local pre-classifier and its short-circuit in MedReferral."""
+
+    def test_known_example_is_classified_with_high_confidence(self, classifier):
+        """Test that a labeled example question maps back to its specialist."""
+        specialist, confidence = classifier.predict("Who should I see for a dust mite allergy?")
+
+        assert specialist == "Allergist"
+        assert confidence > 0.99
+
+    def test_save_and_load_round_trip(self, classifier, tmp_path):
+        """Test that a saved index loads and predicts identically."""
+        path = str(tmp_path / "index.npz")
+        classifier.save(path)
+        loaded = SpecialistClassifier.load(path)
+
+        question = "Which surgeon performs colon cancer surgery?"
+        assert loaded.predict(question) == classifier.predict(question)
+
+    def test_extra_corpus_with_unknown_specialist_raises(self):
+        """Test that user-supplied examples must use known specialist names."""
+        with pytest.raises(ValueError):
+            SpecialistClassifier.from_examples(extra={"Psychologist": ["I feel anxious"]})
+
+    @patch('litellm.completion')
+    def test_confident_prediction_skips_llm(self, mock_completion, classifier):
+        """Test that high-confidence questions are answered locally."""
+        referral = MedReferral(classifier=classifier, classifier_threshold=0.9)
+        result = referral.get_specialist_recommendation("Who performs heart bypass surgery?")
+
+        assert result == "Cardiothoracic Surgeon"
+        mock_completion.assert_not_called()
+
+    @patch('litellm.completion')
+    def test_low_confidence_prediction_falls_back_to_llm(self, mock_completion, classifier):
+        """Test that uncertain questions still go to the LLM."""
+        mock_completion.return_value = _mock_response("Specialists: Orthopedic Surgeon")
+
+        referral = MedReferral(classifier=classifier, classifier_threshold=0.9)
+        result = referral.get_specialist_recommendation("My knee hurts after running")
+
+        assert result == "Orthopedic Surgeon"
+        mock_completion.assert_called_once()
+
+
+class TestPackedRecommendations:
+    """Test packing several questions into one completion."""
+
+    @patch('litellm.completion')
+    def test_pack_classifies_questions_in_one_call(self, mock_completion):
+        """Test that a pack is answered by a single completion in input order."""
+        mock_completion.return_value = _mock_response(
+            "1. Specialists: Dermatologist\n"
+            "2. Specialists: Cardiologist, Pulmonologist\n"
+            "3. Specialists: Urologist"
+        )
+
+        referral = MedReferral()
+        results = referral.get_specialist_recommendations(
+            ["itchy rash", "racing heartbeat", "kidney stones"], pack_size=3
+        )
+
+        assert results == ["Dermatologist", "Cardiologist, Pulmonologist", "Urologist"]
+        mock_completion.assert_called_once()
+        content = mock_completion.call_args.kwargs['messages'][1]['content']
+        assert '3. Question: "kidney stones"' in content
+
+    @patch('litellm.completion')
+    def test_missing_or_invalid_answers_fall_back_to_single_calls(self, mock_completion):
+        """Test that unanswered items are retried individually."""
+        mock_completion.side_effect = [
+            _mock_response("1. Specialists: Dermatologist\n2. Specialists: Psychologist"),
+            _mock_response("Specialists: Psychiatrist"),
+            _mock_response("Specialists: Urologist"),
+        ]
+
+        referral = MedReferral()
+        results = referral.get_specialist_recommendations(
+            ["itchy rash", "low mood", "kidney stones"], max_concurrency=1, pack_size=3
+        )
+
+        assert results == ["Dermatologist", "Psychiatrist", "Urologist"]
+        assert mock_completion.call_count == 3
+
+    @patch('litellm.completion')
+    def test_fallbacks_are_looked_up_once(self, mock_completion):
+        """Test that single-call fallbacks do not count a second cache miss."""
+        mock_completion.side_effect = [
+            _mock_response("1. Specialists: Dermatologist"),
+            _mock_response("Specialists: Urologist"),
+        ]
+        cache = LRUCache()
+
+        referral = MedReferral(cache=cache)
+        results = referral.get_specialist_recommendations(["itchy rash", "kidney stones"], pack_size=2)
+
+        assert results == ["Dermatologist", "Urologist"]
+        assert cache.stats()["misses"] == 2
+        assert referral.get_specialist_recommendation("kidney stones") == "Urologist"
+        assert mock_completion.call_count == 2
+
+    @patch('litellm.completion')
+    def test_cached_questions_are_not_packed(self, mock_completion):
+        """Test that questions answered locally are left out of the pack."""
+        referral = MedReferral(cache=LRUCache())
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        referral.get_specialist_recommendation("itchy rash")
+
+        mock_completion.return_value = _mock_response(
+            "1. Specialists: Cardiologist\n2. Specialists: Urologist"
+        )
+        results = referral.get_specialist_recommendations(
+            ["racing heartbeat", "itchy rash", "kidney stones"], pack_size=3
+        )
+
+        assert results == ["Cardiologist", "Dermatologist", "Urologist"]
+        assert mock_completion.call_count == 2
+        content = mock_completion.call_args.kwargs['messages'][1]['content']
+        assert "itchy rash" not in content
+
+
+class _FakeStream:
+    """A streamed completion that records how many chunks were consumed."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.consumed = 0
+        self.closed = False
+
+    def _chunk(self, text):
+        chunk = Mock()
+        chunk.choices = [Mock()]
+        chunk.choices[0].delta.content = text
+        return chunk
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self.consumed += 1
+            yield self._chunk(piece)
+
+    async def __aiter__(self):
+        for piece in self.pieces:
+            self.consumed += 1
+            yield self._chunk(piece)
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+
+class TestStreamingRecommendation:
+    """Test streaming early-exit parsing of the specialists line."""
+
+    VERBOSE = ["Special", "ists: Cardio", "logist, Pulmon", "ologist\n",
+               "These specialists ", "can help because ", "chest pain ", "is serious."]
+
+    @patch('litellm.completion')
+    def test_stream_stops_after_specialists_line(self, mock_completion):
+        """Test that the stream is closed once the answer line ends."""
+        stream = _FakeStream(self.VERBOSE)
+        mock_completion.return_value = stream
+
+        referral = MedReferral(stream=True)
+        result = referral.get_specialist_recommendation("I have chest pain")
+
+        assert result == "Cardiologist, Pulmonologist"
+        assert stream.consumed == 4
+        assert stream.closed
+        assert mock_completion.call_args.kwargs['stream'] is True
+
+    @patch('litellm.completion')
+    def test_stream_stops_after_name_ending_in_specialist(self, mock_completion):
+        """Test that a specialist name containing "Specialist" does not hide the line end."""
+        stream = _FakeStream(["Specialists", ":", " Infectious", " Disease", " Specialist", "\n",
+                              "Because", " fever", " after", " travel", " needs", " workup."])
+        mock_completion.return_value = stream
+
+        referral = MedReferral(stream=True)
+        result = referral.get_specialist_recommendation("Fever after a trip abroad")
+
+        assert result == "Infectious Disease Specialist"
+        assert stream.consumed == 6
+        assert stream.closed
+
+    @patch('litellm.completion')
+    def test_stream_without_newline_is_parsed_at_end(self, mock_completion):
+        """Test that an answer ending without a newline is still parsed."""
+        mock_completion.return_value = _FakeStream(["Specialists: Derm", "atologist"])
+
+        referral = MedReferral(stream=True)
+
+        assert referral.get_specialist_recommendation("I have a rash") == "Dermatologist"
+
+    @patch('litellm.acompletion', new_callable=AsyncMock)
+    def test_async_stream_stops_after_specialists_line(self, mock_acompletion):
+        """Test early exit on the async path."""
+        stream = _FakeStream(self.VERBOSE)
+        mock_acompletion.return_value = stream
+
+        referral = AsyncMedReferral(stream=True)
+        result = asyncio.run(referral.get_specialist_recommendation("I have chest pain"))
+
+        assert result == "Cardiologist, Pulmonologist"
+        assert stream.consumed == 4
+        assert stream.closed
+
+
+class TestSpecialistMatcher:
+    """Test mapping free-text specialist mentions to canonical names."""
+
+    def test_aliases_and_case_map_to_canonical_names(self):
+        """Test that abbreviations and lowercase names are recovered."""
+        found = MedReferral.matcher.find("ENT, cardiologist, Otolaryngologist")
+
+        assert found == ["Otolaryngologist (ENT Specialist)", "Cardiologist"]
+
+    def test_alias_can_map_to_several_specialists(self):
+        """Test that a combined alias expands to every specialist it names."""
+        assert MedReferral.matcher.find("an OB/GYN") == ["Obstetrician", "Gynecologist"]
+
+    def test_longest_match_wins(self):
+        """Test that a longer canonical name is preferred over a contained one."""
+        found = MedReferral.matcher.find("Child and Adolescent Psychiatrist")
+
+        assert found == ["Child and Adolescent Psychiatrist"]
+
+    def test_fuzzy_matching_is_opt_in_and_bounded(self):
+        """Test that max_edits=1 recovers one-letter typos but unrelated specialties do not match."""
+        matcher = SpecialistMatcher(MedReferral.medical_specialists, SPECIALIST_ALIASES, max_edits=1)
+
+        assert matcher.find("Dermatolgist") == ["Dermatologist"]
+        assert matcher.find("Psychologist") == []
+
+    def test_fuzzy_matching_is_off_by_default(self):
+        """Test that the default matcher only accepts exact (normalized) names."""
+        matcher = MedReferral.matcher
+
+        assert matcher.max_edits == 0
+        assert matcher.find("Dermatolgist") == []
+        assert matcher.find("dermatologists") == ["Dermatologist"]
+
+    def test_other_real_specialties_are_not_misrouted(self):
+        """Test that real names one edit away from a supported specialty do not match it."""
+        matcher = MedReferral.matcher
+
+        assert matcher.find("Hepatologist") == []
+        assert matcher.find("Interval medicine doctor") == []
+
+    def test_unknown_alias_target_raises(self):
+        """Test that aliases must point at known specialists."""
+        with pytest.raises(ValueError):
+            SpecialistMatcher(MedReferral.medical_specialists, {"therapist": ("Psychologist",)})
+
+    @patch('litellm.completion')
+    def test_recommendation_recovers_non_canonical_names(self, mock_completion):
+        """Test that answers using aliases no longer fall through to the error path."""
+        mock_completion.return_value = _mock_response("Specialists: ENT, cardiologist")
+
+        referral = MedReferral()
+        result = referral.get_specialist_recommendation("I have ear pain and palpitations")
+
+        assert result == "Otolaryngologist (ENT Specialist), Cardiologist"
+
+    @patch('litellm.completion')
+    def test_prose_without_answer_line_is_unverified(self, mock_completion):
+        """Test that specialists named outside a "Specialists:" line are only candidates."""
+        mock_completion.return_value = _mock_response("You should see a neurologist soon.")
+
+        result = MedReferral().recommend("I have migraines")
+
+        assert result.status is RecommendationStatus.UNVERIFIED
+        assert result.specialists == ("Neurologist",)
+        assert str(result) == "Neurologist (Note: Please verify with a healthcare professional.)"
+
+    @patch('litellm.completion')
+    def test_prose_mentions_are_not_trusted(self, mock_completion):
+        """Test that a specialist the prose rules out does not produce an OK answer."""
+        mock_completion.return_value = _mock_response("You do not need a Cardiologist; see a Dermatologist.")
+
+        result = MedReferral().recommend("I have a rash")
+
+        assert result.status is RecommendationStatus.UNVERIFIED
+
+
+class TestRecommendation:
+    """Test the structured Recommendation result."""
+
+    @patch('litellm.completion')
+    def test_recommend_returns_structured_result(self, mock_completion):
+        """Test that recommend carries specialists, status, raw text, model and tokens."""
+        response = _mock_response("Specialists: Cardiologist, Pulmonologist")
+        response.usage.prompt_tokens = 120
+        response.usage.completion_tokens = 6
+        mock_completion.return_value = response
+
+        result = MedReferral(model="gpt-4o").recommend("I have chest pain")
+
+        assert result.specialists == ("Cardiologist", "Pulmonologist")
+        assert result.status is RecommendationStatus.OK
+        assert result.raw == "Specialists: Cardiologist, Pulmonologist"
+        assert result.model == "gpt-4o"
+        assert (result.prompt_tokens, result.completion_tokens) == (120, 6)
+        assert result.latency >= 0
+        assert result.source == "llm"
+
+    @patch('litellm.completion')
+    def test_string_rendering_matches_legacy_api(self, mock_completion):
+        """Test that str() of each status matches get_specialist_recommendation."""
+        referral = MedReferral()
+        for content in ["Specialists: Dermatologist",
+                        "Specialists: InvalidSpecialist1",
+                        "I recommend seeing a doctor"]:
+            mock_completion.return_value = _mock_response(content)
+            assert str(referral.recommend("q")) == referral.get_specialist_recommendation("q")
+
+        mock_completion.side_effect = Exception("API Connection Error")
+        result = referral.recommend("q")
+        assert result.status is RecommendationStatus.ERROR
+        assert result.error == "API Connection Error"
+        assert str(result) == "Error: API Connection Error"
+
+    def test_unverified_result_keeps_note(self):
+        """Test the disclaimer rendering for answers with no known specialist."""
+        result = Recommendation((), RecommendationStatus.UNVERIFIED, "Specialists: Psychologist")
+
+        assert str(result) == "Psychologist (Note: Please verify with a healthcare professional.)"
+
+    def test_slots_and_round_trip(self):
+        """Test that results are compact and serialize losslessly."""
+        result = Recommendation(("Urologist",), model="gpt-4o", prompt_tokens=10, latency=0.5)
+
+        assert not hasattr(result, "__dict__")
+        restored = Recommendation.from_dict(result.to_dict())
+        assert restored.to_dict() == result.to_dict()
+        assert restored.status is RecommendationStatus.OK
+
+    @patch('litellm.completion')
+    def test_cache_hit_reports_source_and_no_tokens(self, mock_completion):
+        """Test that cached answers are marked and cost no tokens."""
+        response = _mock_response("Specialists: Cardiologist")
+        response.usage.prompt_tokens = 120
+        response.usage.completion_tokens = 6
+        mock_completion.return_value = response
+
+        referral = MedReferral(cache=LRUCache())
+        referral.recommend("I have chest pain")
+        result = referral.recommend("I have chest pain")
+
+        assert result.source == "cache"
+        assert result.specialists == ("Cardiologist",)
+        assert result.prompt_tokens == result.completion_tokens == 0
+
+    @patch('litellm.completion')
+    def test_recommend_many_returns_results_in_order(self, mock_completion):
+        """Test the structured batch API."""
+        mock_completion.return_value = _mock_response("Specialists: Neurologist")
+
+        results = MedReferral().recommend_many(["a", "b"])
+
+        assert [r.specialists for r in results] == [("Neurologist",), ("Neurologist",)]
+
+
+class _ProviderError(Exception):
+    """A provider error carrying an HTTP status code and headers, like litellm's."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = Mock(headers=headers or {})
+
+
+class TestResilience:
+    """Test retries, rate limiting and the circuit breaker."""
+
+    def test_retryable_errors_are_retried(self):
+        """Test that 429s are retried until the provider answers."""
+        backend = Mock()
+        backend.completion.side_effect = [_ProviderError(429), _ProviderError(503),
+                                          _mock_response("Specialists: Urologist")]
+        resilient = ResilientBackend(backend, retry=RetryPolicy(max_attempts=3, base_delay=0))
+
+        referral = MedReferral(backend=resilient)
+
+        assert referral.get_specialist_recommendation("kidney stones") == "Urologist"
+        assert resilient.stats()["retry"] == {"retries": 2, "gave_up": 0}
+
+    def test_non_retryable_errors_fail_immediately(self):
+        """Test that client errors such as 401 are not retried."""
+        backend = Mock()
+        backend.completion.side_effect = _ProviderError(401)
+        resilient = ResilientBackend(backend, retry=RetryPolicy(base_delay=0))
+
+        result = MedReferral(backend=resilient).get_specialist_recommendation("q")
+
+        assert result == "Error: HTTP 401"
+        assert backend.completion.call_count == 1
+
+    def test_retry_after_header_sets_delay(self):
+        """Test that Retry-After is honoured, and oversized values give up."""
+        policy = RetryPolicy(max_delay=10)
+
+        assert policy.delay(1, _ProviderError(429, {"retry-after": "2"})) == 2.0
+        assert policy.delay(1, _ProviderError(429, {"retry-after": "60"})) is None
+        assert policy.delay(3, _ProviderError(429)) is None
+
+    def test_token_bucket_throttles_bursts(self):
+        """Test that requests beyond the burst capacity wait for tokens."""
+        bucket = TokenBucket(rate=100, capacity=2)
+        for _ in range(4):
+            bucket.acquire()
+
+        assert bucket.stats()["throttled"] == 2
+        assert bucket.stats()["wait_time"] > 0
+
+    def test_circuit_breaker_opens_and_fails_fast(self):
+        """Test that repeated provider failures open the circuit."""
+        backend = Mock()
+        backend.completion.side_effect = _ProviderError(503)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        resilient = ResilientBackend(backend, retry=RetryPolicy(max_attempts=1),
+                                     circuit_breaker=breaker)
+
+        for _ in range(2):
+            with pytest.raises(_ProviderError):
+                resilient.completion(model="m", messages=[])
+        with pytest.raises(CircuitOpenError):
+            resilient.completion(model="m", messages=[])
+
+        assert backend.completion.call_count == 2
+        assert breaker.stats() == {"state": "open", "opened": 1, "rejected": 1}
+
+    def test_circuit_breaker_recovers_after_trial_call(self):
+        """Test that a successful trial call closes the circuit again."""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        assert breaker.state == "open"
+
+        breaker.before_call()
+        assert breaker.state == "half_open"
+        breaker.record_success()
+        assert breaker.state == "closed"
+
+    def test_cancelled_trial_call_releases_half_open_circuit(self):
+        """Test that cancelling the half-open trial does not leave the circuit stuck."""
+        backend = Mock()
+        backend.acompletion = AsyncMock(side_effect=_ProviderError(503))
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        resilient = ResilientBackend(backend, retry=RetryPolicy(max_attempts=1), circuit_breaker=breaker)
+
+        async def run():
+            with pytest.raises(_ProviderError):
+                await resilient.acompletion(model="m", messages=[])
+            await asyncio.sleep(0.06)
+
+            async def hang(**kwargs):
+                await asyncio.sleep(10)
+            backend.acompletion = AsyncMock(side_effect=hang)
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(resilient.acompletion(model="m", messages=[]), 0.01)
+            assert breaker.state == "open"
+
+            backend.acompletion = AsyncMock(return_value=_mock_response("Specialists: Urologist"))
+            return await resilient.acompletion(model="m", messages=[])
+
+        response = asyncio.run(run())
+
+        assert response.choices[0].message.content == "Specialists: Urologist"
+        assert breaker.state == "closed"
+
+    def test_async_path_retries(self):
+        """Test that acompletion is retried the same way."""
+        backend = Mock()
+        backend.acompletion = AsyncMock(side_effect=[_ProviderError(429),
+                                                     _mock_response("Specialists: Urologist")])
+        resilient = ResilientBackend(backend, retry=RetryPolicy(base_delay=0))
+
+        result = asyncio.run(AsyncMedReferral(backend=resilient).get_specialist_recommendation("q"))
+
+        assert result == "Urologist"
+
+
+class TestModelChain:
+    """Test model fallback chains and hedged requests."""
+
+    def test_falls_back_to_next_model_on_error(self):
+        """Test that a failing primary is replaced by the next model."""
+        backend = Mock()
+        backend.completion.side_effect = [Exception("API Connection Error"),
+                                          _mock_response("Specialists: Urologist")]
+
+        referral = MedReferral(backend=backend, model=["primary", "secondary"])
+        result = referral.recommend("kidney stones")
+
+        assert result.specialists == ("Urologist",)
+        assert result.model == "secondary"
+        assert [c.kwargs['model'] for c in backend.completion.call_args_list] == ["primary", "secondary"]
+        assert referral.fallbacks == 1
+
+    def test_falls_back_when_no_valid_specialist(self):
+        """Test that an answer failing validation also moves down the chain."""
+        backend = Mock()
+        backend.completion.side_effect = [_mock_response("Specialists: Psychologist"),
+                                          _mock_response("Specialists: Psychiatrist")]
+
+        referral = MedReferral(backend=backend, model=("primary", "secondary"))
+
+        assert referral.get_specialist_recommendation("low mood") == "Psychiatrist"
+
+    def test_all_models_failing_returns_last_error(self):
+        """Test the error reported when the whole chain fails."""
+        backend = Mock()
+        backend.completion.side_effect = [Exception("first down"), Exception("second down")]
+
+        referral = MedReferral(backend=backend, model=["primary", "secondary"])
+
+        assert referral.get_specialist_recommendation("q") == "Error: second down"
+
+    def test_slow_primary_is_hedged(self):
+        """Test that a slow primary triggers the secondary and the first valid answer wins."""
+        import time
+
+        def fake_completion(**kwargs):
+            if kwargs['model'] == "primary":
+                time.sleep(0.5)
+                return _mock_response("Specialists: Cardiologist")
+            return _mock_response("Specialists: Neurologist")
+
+        backend = Mock()
+        backend.completion.side_effect = fake_completion
+
+        referral = MedReferral(backend=backend, model=["primary", "secondary"],
+                               hedge_percentile=95, hedge_after=0.02)
+        start = time.perf_counter()
+        result = referral.recommend("headache")
+
+        assert result.model == "secondary"
+        assert result.specialists == ("Neurologist",)
+        assert time.perf_counter() - start < 0.4
+        assert referral.hedged == 1
+
+    def test_hedge_deadline_tracks_primary_latency(self):
+        """Test that the deadline becomes a percentile of observed primary latencies."""
+        referral = MedReferral(model=["primary", "secondary"], hedge_percentile=90,
+                               hedge_after=5.0, hedge_min_samples=10)
+        assert referral._hedge_deadline() == 5.0
+
+        for latency in range(1, 11):
+            referral._record_primary_latency(latency / 10)
+
+        assert referral._hedge_deadline() == 0.9
+        referral.hedge_percentile = 50
+        assert referral._hedge_deadline() == 0.5
+
+    def test_queued_requests_are_not_hedged(self):
+        """Test that a wide batch does not hedge requests that only waited for a thread."""
+        from bench import FakeBackend
+
+        backend = FakeBackend(latency=0.05)
+        referral = MedReferral(backend=backend, model=["primary", "secondary"], hedge_percentile=99,
+                               hedge_after=0.15, hedge_min_samples=1000)
+
+        results = referral.recommend_many([f"question {n}" for n in range(256)], max_concurrency=128)
+
+        assert all(result.status is RecommendationStatus.OK for result in results)
+        assert referral.hedged == 0
+        assert backend.calls == 256
+        referral.close()
+
+    def test_fast_primary_failure_counts_as_fallback(self):
+        """Test that a primary failing before the hedge deadline is counted as a fallback."""
+        backend = Mock()
+        backend.completion.side_effect = lambda **kwargs: (
+            _mock_response("Specialists: Urologist") if kwargs["model"] == "secondary"
+            else _raise(Exception("boom")))
+        referral = MedReferral(backend=backend, model=["primary", "secondary"], hedge_percentile=90,
+                               hedge_after=5.0)
+
+        result = referral.recommend("kidney stones")
+
+        assert result.model == "secondary"
+        assert referral.fallbacks == 1
+        assert referral.hedged == 0
+
+    def test_async_hedge_cancels_slow_primary(self):
+        """Test that the async path hedges and cancels the losing request."""
+        cancelled = []
+
+        async def fake_acompletion(**kwargs):
+            if kwargs['model'] == "primary":
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+            return _mock_response("Specialists: Neurologist")
+
+        backend = Mock()
+        backend.acompletion.side_effect = fake_acompletion
+
+        referral = AsyncMedReferral(backend=backend, model=["primary", "secondary"],
+                                    hedge_percentile=95, hedge_after=0.01)
+        result = asyncio.run(referral.recommend("headache"))
+
+        assert result.model == "secondary"
+        assert cancelled == [True]
+
+
+class TestPromptTemplate:
+    """Test prompt precompilation and few-shot budgeting."""
+
+    def test_static_prefix_is_shared_and_compact(self):
+        """Test that only the user message varies and no indentation is sent."""
+        template = PromptTemplate()
+        first = template.messages("I have a rash")
+        second = template.messages("I have chest pain")
+
+        assert first[0] == second[0]
+        assert first[0]["role"] == "system"
+        assert first[1]["content"] == 'Question: "I have a rash"'
+        assert not any(line.startswith(" ") for line in first[0]["content"].splitlines())
+
+    def test_token_budget_limits_examples(self):
+        """Test that few-shot examples are dropped to fit the budget."""
+        template = PromptTemplate.from_examples_file(token_budget=300)
+
+        assert 0 < len(template.examples) < 45
+        assert template.prefix_tokens <= 300
+        assert PromptTemplate(token_budget=10).examples == ()
+
+    def test_examples_file_covers_distinct_specialists(self):
+        """Test that examples are drawn across specialists first."""
+        template = PromptTemplate.from_examples_file(token_budget=None)
+        specialists = [s for _, (s,) in template.examples]
+
+        assert len(specialists) == len(set(specialists)) == 45
+
+    def test_estimate_tokens_grows_with_question(self):
+        """Test the per-request token estimate."""
+        template = PromptTemplate()
+
+        assert template.estimate_tokens("rash") > template.prefix_tokens
+        assert template.estimate_tokens("rash " * 50) > template.estimate_tokens("rash")
+
+    @patch('litellm.completion')
+    def test_custom_template_is_sent(self, mock_completion):
+        """Test that MedReferral sends the configured template."""
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        template = PromptTemplate(examples=())
+
+        MedReferral(prompt=template).get_specialist_recommendation("I have a rash")
+
+        assert mock_completion.call_args.kwargs['messages'] == template.messages("I have a rash")
+
+    @patch('litellm.completion')
+    def test_missing_usage_is_estimated(self, mock_completion):
+        """Test that prompt tokens are estimated when the provider reports none."""
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        referral = MedReferral()
+
+        result = referral.recommend("I have a rash")
+
+        assert result.prompt_tokens == referral.prompt.estimate_tokens("I have a rash")
+
+
+class TestPromptCaching:
+    """Test provider prompt-prefix caching."""
+
+    def test_claude_models_mark_the_static_prefix(self):
+        """Test that only Claude models get explicit cache_control markers."""
+        template = PromptTemplate()
+        template.min_cache_tokens = 0
+        messages = template.messages("I have a rash")
+
+        marked = template.provider_messages(messages, "anthropic/claude-3-5-haiku-latest")
+
+        assert marked[0]["content"] == [{
+            "type": "text",
+            "text": messages[0]["content"],
+            "cache_control": {"type": "ephemeral"},
+        }]
+        assert marked[1] == messages[1]
+        assert template.provider_messages(messages, "gpt-4o-mini") is messages
+        assert PromptTemplate(cache_control=False).provider_messages(messages, "claude-3-5-haiku") is messages
+        assert PromptTemplate(cache_control=True).provider_messages(messages, "gpt-4o-mini") != messages
+
+    def test_prefix_below_provider_minimum_is_not_marked(self):
+        """Test that "auto" skips the marker on prefixes too short for the provider to cache."""
+        template = PromptTemplate()
+        messages = template.messages("I have a rash")
+
+        assert template.prefix_tokens < PromptTemplate.min_cache_tokens
+        assert template.provider_messages(messages, "claude-3-5-haiku") is messages
+        assert PromptTemplate(cache_control=True).provider_messages(messages, "claude-3-5-haiku") != messages
+
+    @patch('litellm.completion')
+    def test_marked_request_shares_the_cache_key(self, mock_completion):
+        """Test that the marker is applied at send time and not to the response cache key."""
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        referral = MedReferral(cache=LRUCache(), model="claude-3-5-haiku-latest",
+                               prompt=PromptTemplate(cache_control=True))
+
+        referral.get_specialist_recommendation("I have a rash")
+        referral.get_specialist_recommendation("i have a rash")
+
+        sent = mock_completion.call_args.kwargs['messages']
+        assert sent[0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+        assert mock_completion.call_count == 1
+
+    @patch('litellm.completion')
+    def test_cached_tokens_are_reported(self, mock_completion):
+        """Test that OpenAI- and Anthropic-style cached token counts are read."""
+        openai_style = _mock_response("Specialists: Dermatologist")
+        openai_style.usage = Mock(prompt_tokens=1200, completion_tokens=5)
+        openai_style.usage.prompt_tokens_details.cached_tokens = 1024
+        anthropic_style = _mock_response("Specialists: Dermatologist")
+        anthropic_style.usage = Mock(prompt_tokens=1200, completion_tokens=5, cache_read_input_tokens=1100)
+        anthropic_style.usage.prompt_tokens_details = None
+        mock_completion.side_effect = [openai_style, anthropic_style]
+        referral = MedReferral()
+
+        assert referral.recommend("I have a rash").cached_tokens == 1024
+        assert referral.recommend("I have hives").cached_tokens == 1100
+
+    def test_repeated_prefix_is_cached_by_fake_backend(self):
+        """Test that the benchmark stand-in reports cached tokens after the first call."""
+        from bench import FakeBackend
+
+        referral = MedReferral(backend=FakeBackend())
+        first = referral.recommend("Who performs heart bypass surgery?")
+        second = referral.recommend("Who should I see for a dust mite allergy?")
+
+        assert first.cached_tokens == 0
+        assert 0 < second.cached_tokens < second.prompt_tokens
+        assert Recommendation.from_dict(second.to_dict()).cached_tokens == second.cached_tokens
+
+
+class TestBatchCLI:
+    """Test the non-interactive batch command."""
+
+    def test_reads_jsonl_and_csv_lazily(self, tmp_path):
+        """Test that both input formats yield indexed questions."""
+        jsonl = tmp_path / "q.jsonl"
+        jsonl.write_text('"itchy rash"\n\n{"question": "blurry vision", "id": 7}\n')
+        csv_file = tmp_path / "q.csv"
+        csv_file.write_text('id,question\n1,itchy rash\n2,"swollen knee, left"\n')
+
+        assert list(read_questions(str(jsonl))) == [(0, "itchy rash"), (1, "blurry vision")]
+        assert list(read_questions(str(csv_file))) == [(0, "itchy rash"), (1, "swollen knee, left")]
+        with pytest.raises(ValueError):
+            list(read_questions(str(csv_file), field="text"))
+
+    def test_results_are_written_as_they_finish(self):
+        """Test that a slow request does not hold back later results."""
+        release = threading.Event()
+
+        def completion(**kwargs):
+            if "slow question" in kwargs["messages"][-1]["content"]:
+                release.wait(5)
+            return _mock_response("Specialists: Dermatologist")
+
+        referral = MedReferral(backend=Mock(completion=Mock(side_effect=completion)))
+        completed = referral.iter_completed(["slow question", "fast question"], max_concurrency=2)
+
+        assert next(completed)[0] == 1
+        release.set()
+        assert next(completed)[0] == 0
+
+    def test_resume_skips_answered_items_and_retries_errors(self, tmp_path):
+        """Test that the output file acts as a checkpoint."""
+        questions = tmp_path / "q.jsonl"
+        questions.write_text("\n".join(json.dumps(q) for q in ["rash one", "rash two", "rash three"]))
+        out = tmp_path / "r.jsonl"
+        out.write_text(
+            json.dumps({"index": 0, "status": "ok"}) + "\n"
+            + json.dumps({"index": 1, "status": "error"}) + "\n"
+            + '{"index": 2, "sta'
+        )
+        backend = Mock()
+        backend.completion.return_value = _mock_response("Specialists: Dermatologist")
+
+        counts = run_batch(MedReferral(backend=backend), str(questions), str(out), concurrency=2)
+
+        assert counts == {"written": 2, "skipped": 1, "errors": 0}
+        assert backend.completion.call_count == 2
+        records = [json.loads(line) for line in out.read_text().splitlines()]
+        assert sorted(r["index"] for r in records[2:]) == [1, 2]
+        assert records[-1]["specialists"] == ["Dermatologist"]
+        assert load_checkpoint(str(out)) == {0, 1, 2}
+
+    @patch('litellm.completion')
+    def test_batch_command(self, mock_completion, tmp_path, capsys):
+        """Test the batch subcommand end to end."""
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        questions = tmp_path / "q.csv"
+        questions.write_text("question\nitchy rash\npeeling skin\n")
+        out = tmp_path / "r.jsonl"
+
+        main(["batch", "--in", str(questions), "--out", str(out), "--concurrency", "4"])
+
+        records = [json.loads(line) for line in out.read_text().splitlines()]
+        assert {r["question"]: r["index"] for r in records} == {"itchy rash": 0, "peeling skin": 1}
+        assert "Wrote 2 results" in capsys.readouterr().err
+
+
+class TestReferralService:
+    """Test the HTTP referral service."""
+
+    def test_identical_in_flight_questions_are_coalesced(self):
+        """Test that concurrent duplicates share one LLM call."""
+        release = threading.Event()
+
+        def completion(**kwargs):
+            release.wait(5)
+            return _mock_response("Specialists: Dermatologist")
+
+        backend = Mock(completion=Mock(side_effect=completion))
+        service = ReferralService(MedReferral(backend=backend), batch_window=0.0)
+        futures = [service.submit(q) for q in ["Itchy rash", "itchy  rash", "ITCHY RASH"]]
+        release.set()
+
+        assert [str(f.result(5)) for f in futures] == ["Dermatologist"] * 3
+        assert backend.completion.call_count == 1
+        assert service.stats()["coalesced"] == 2
+        service.close()
+
+    def test_concurrent_questions_are_micro_batched(self):
+        """Test that questions arriving together share one packed completion."""
+        from bench import FakeBackend
+
+        backend = FakeBackend()
+        service = ReferralService(MedReferral(backend=backend), batch_window=0.2, max_batch=8)
+
+        results = service.recommend_many(
+            ["Who performs heart bypass surgery?", "Who should I see for a dust mite allergy?"]
+        )
+
+        assert [str(r) for r in results] == ["Cardiothoracic Surgeon", "Allergist"]
+        assert backend.calls == 1
+        assert service.stats()["mean_batch_size"] == 2
+        service.close()
+
+    def test_fallback_chain_disables_micro_batching(self):
+        """Test that a referral with fallbacks is served question by question through recommend."""
+        from bench import FakeBackend
+
+        backend = FakeBackend()
+        referral = MedReferral(backend=backend, model=["primary", "secondary"])
+        service = ReferralService(referral, batch_window=0.2, max_batch=8)
+
+        results = service.recommend_many(
+            ["Who performs heart bypass surgery?", "Who should I see for a dust mite allergy?"]
+        )
+
+        assert [str(r) for r in results] == ["Cardiothoracic Surgeon", "Allergist"]
+        assert service.max_batch == 1
+        assert backend.calls == 2
+        service.close()
+
+    def test_async_referral_is_rejected(self):
+        """Test that the service refuses a referral whose recommend returns coroutines."""
+        with pytest.raises(TypeError):
+            ReferralService(AsyncMedReferral())
+
+    def test_http_endpoints(self):
+        """Test the single, batch, metrics and error endpoints over HTTP."""
+        from bench import FakeBackend
+
+        service = ReferralService(MedReferral(backend=FakeBackend()))
+        server = make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        def post(path, payload):
+            request = urllib.request.Request(url + path, json.dumps(payload).encode(), method="POST")
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+
+        try:
+            single = post("/recommend", {"question": "Who performs heart bypass surgery?"})
+            batch = post("/recommend/batch", {"questions": ["Who should I see for a dust mite allergy?"]})
+            with urllib.request.urlopen(url + "/metrics") as response:
+                metrics = json.loads(response.read())
+            with pytest.raises(urllib.error.HTTPError) as error:
+                post("/recommend", {"text": "missing question"})
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.close()
+
+        assert single["specialists"] == ["Cardiothoracic Surgeon"]
+        assert batch["results"][0]["specialists"] == ["Allergist"]
+        assert metrics["requests"] == 2
+        assert {"queue_depth", "p95_latency_s"} <= set(metrics)
+        assert error.value.code == 400
+
+
+class TestMetrics:
+    """Test the instrumentation surface."""
+
+    def test_stages_tokens_and_outcomes_are_recorded(self):
+        """Test per-stage timers, token usage, cache hit rate and specialist counts."""
+        from bench import FakeBackend
+
+        metrics = Metrics()
+        referral = MedReferral(backend=FakeBackend(), cache=LRUCache(), metrics=metrics)
+        referral.recommend("Who performs heart bypass surgery?")
+        referral.recommend("Who performs heart bypass surgery?")
+
+        snapshot = metrics.snapshot()
+        assert {"recommend", "prompt", "lookup", "request", "parse", "validate"} <= set(snapshot["stages"])
+        assert snapshot["stages"]["recommend"]["count"] == 2
+        assert snapshot["stages"]["request"]["count"] == 1
+        assert snapshot["outcomes"] == {"cache/ok": 1, "llm/ok": 1}
+        assert snapshot["cache_hit_rate"] == 0.5
+        assert snapshot["tokens"]["prompt"] > 0
+        assert snapshot["specialists"] == {"Cardiothoracic Surgeon": 2}
+
+    def test_hooks_and_tracer_see_every_stage(self):
+        """Test that callbacks and OpenTelemetry-style spans wrap each stage."""
+        seen, spans = [], []
+
+        class _Tracer:
+            @contextlib.contextmanager
+            def start_as_current_span(self, name):
+                spans.append(name)
+                yield
+
+        mock_backend = Mock()
+        mock_backend.completion.return_value = _mock_response("Specialists: Dermatologist")
+        metrics = Metrics(hooks=[lambda stage, seconds: seen.append(stage)], tracer=_Tracer())
+
+        MedReferral(backend=mock_backend, metrics=metrics).recommend("I have an itchy rash")
+
+        assert seen[-1] == "recommend"
+        assert "request" in seen
+        assert spans[0] == "medrefer.recommend"
+        assert len(spans) == len(seen)
+
+    def test_retries_are_counted(self):
+        """Test that ResilientBackend reports retries to the shared metrics."""
+        metrics = Metrics()
+        inner = Mock()
+        inner.completion.side_effect = [_ProviderError(503), _mock_response("Specialists: Dermatologist")]
+        backend = ResilientBackend(inner, retry=RetryPolicy(base_delay=0), metrics=metrics)
+
+        MedReferral(backend=backend, metrics=metrics).recommend("I have an itchy rash")
+
+        assert metrics.snapshot()["retries"] == 1
+
+    def test_prometheus_export(self):
+        """Test the Prometheus text exposition format."""
+        metrics = Metrics()
+        metrics.observe("request", 0.02)
+        metrics.record(Recommendation(("Internal Medicine Doctor (Internist)",), prompt_tokens=10))
+
+        text = metrics.prometheus()
+
+        assert 'medrefer_stage_seconds_bucket{stage="request",le="0.05"} 1' in text
+        assert 'medrefer_stage_seconds_count{stage="request"} 1' in text
+        assert 'medrefer_recommendations_total{source="llm",status="ok"} 1' in text
+        assert 'medrefer_tokens_total{kind="prompt"} 10' in text
+        assert 'specialist="Internal Medicine Doctor (Internist)"} 1' in text
+
+    def test_disabled_metrics_use_a_shared_no_op(self):
+        """Test that stages cost nothing but a None check without metrics."""
+        referral = MedReferral()
+
+        assert referral._stage("request") is referral._stage("parse")
+
+
+class TestLazyImports:
+    """Test that heavy dependencies are only imported when used."""
+
+    def test_import_does_not_load_heavy_modules(self):
+        """Test that importing medrefer and building a MedReferral skips litellm and numpy."""
+        script = (
+            "import sys; from medrefer import MedReferral; MedReferral(); "
+            "print(sorted(m for m in ('litellm', 'numpy', 'asyncio') if m in sys.modules))"
+        )
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        assert output.stdout.strip() == "[]"
+
+    @patch('litellm.completion')
+    def test_patched_litellm_is_used_through_lazy_module(self, mock_completion):
+        """Test that the deferred module still resolves patched attributes per call."""
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+
+        assert MedReferral().get_specialist_recommendation("I have an itchy rash") == "Dermatologist"
+
+
+class TestLLMClient:
+    """Test the shared provider client."""
+
+    @patch('litellm.api_key', 'untouched')
+    @patch('litellm.completion')
+    def test_config_is_passed_per_call_without_globals(self, mock_completion):
+        """Test that the client sends its configuration with each call instead of setting globals."""
+        import litellm
+
+        mock_completion.return_value = _mock_response("Specialists: Dermatologist")
+        client = LLMClient(api_key="sk-test", api_base="https://llm.example", api_version="2024-06-01")
+
+        MedReferral(backend=client).get_specialist_recommendation("I have an itchy rash")
+        client.completion(model="gpt-4o-mini", messages=[], api_base="https://override.example")
+
+        first, second = mock_completion.call_args_list
+        assert first.kwargs["api_key"] == "sk-test"
+        assert first.kwargs["api_version"] == "2024-06-01"
+        assert second.kwargs["api_base"] == "https://override.example"
+        assert litellm.api_key == "untouched"
+
+    def test_default_client_is_shared(self):
+        """Test that instances created without a backend share one client."""
+        assert MedReferral().backend is MedReferral().backend
+        assert isinstance(MedReferral().backend, LLMClient)
+        assert "api_key" not in MedReferral().backend._config
+
+    @patch('litellm.acompletion', new_callable=AsyncMock)
+    def test_async_calls_share_one_pooled_session(self, mock_acompletion):
+        """Test that a pooled client reuses one keep-alive session per event loop."""
+        mock_acompletion.return_value = _mock_response("Specialists: Dermatologist")
+        client = LLMClient(max_connections=8)
+        referral = AsyncMedReferral(backend=client)
+
+        async def run():
+            await referral.get_specialist_recommendations(["itchy rash", "blurry vision"])
+            sessions = {id(call.kwargs["shared_session"]) for call in mock_acompletion.call_args_list}
+            await client.aclose()
+            return sessions
+
+        assert len(asyncio.run(run())) == 1
+
+
+class TestStructuredOutput:
+    """Test the JSON specialist-code output mode."""
+
+    def test_prompt_lists_codes_and_renders_examples_as_json(self):
+        """Test that the JSON prompt maps codes to specialists and shows JSON answers."""
+        template = PromptTemplate(output="json")
+        system = template.messages("q")[0]["content"]
+
+        assert f"0: {template.codes[0]}" in system
+        assert template._encode(DEFAULT_FEW_SHOT[0][1]) in system
+        assert "Specialists:" not in system
+
+    def test_decode_is_strict(self):
+        """Test that only well-formed in-range integer codes are accepted."""
+        template = PromptTemplate(output="json")
+        derm = template.codes.index("Dermatologist")
+
+        assert template.decode(f'{{"codes": [{derm}, {derm}]}}') == ("Dermatologist",)
+        assert template.decode(f"```json\n[{derm}]\n```") == ("Dermatologist",)
+        assert template.decode('{"codes": []}') == ()
+        for bad in ("Specialists: Dermatologist", "[true]", f"[{len(template.codes)}]", '["1"]', '{"x": 1}'):
+            assert template.decode(bad) is None
+
+    @patch('litellm.supports_response_schema', return_value=True)
+    @patch('litellm.completion')
+    def test_json_mode_sends_schema_and_decodes_codes(self, mock_completion, mock_supports):
+        """Test that JSON mode sends a schema, a small budget, and decodes the code answer."""
+        referral = MedReferral(model="gpt-4o-mini", output="json")
+        code = referral.prompt.codes.index("Cardiologist")
+        mock_completion.return_value = _mock_response(f'{{"codes":[{code}]}}')
+
+        result = referral.recommend("My chest hurts")
+
+        kwargs = mock_completion.call_args.kwargs
+        assert kwargs["max_tokens"] == 20
+        assert kwargs["response_format"]["json_schema"]["schema"]["required"] == ["codes"]
+        assert result.specialists == ("Cardiologist",)
+        assert result.status is RecommendationStatus.OK
+
+    @patch('litellm.supports_response_schema', return_value=False)
+    @patch('litellm.completion')
+    def test_unsupported_models_fall_back_to_text(self, mock_completion, mock_supports):
+        """Test that the schema is dropped for models without support and text answers still parse."""
+        mock_completion.return_value = _mock_response("Specialists: Neurologist")
+        referral = MedReferral(model="ollama/llama3", output="json")
+
+        result = referral.recommend("I get migraines")
+
+        assert "response_format" not in mock_completion.call_args.kwargs
+        assert result.specialists == ("Neurologist",)
+        referral.recommend("I get dizzy spells")
+        mock_supports.assert_called_once()
+
+    def test_fake_backend_answers_json_prompts(self):
+        """Test that the benchmark backend answers code prompts with codes."""
+        from bench import FakeBackend, load_examples
+
+        question, label = load_examples()[0]
+        result = MedReferral(backend=FakeBackend(), output="json").recommend(question)
+
+        assert result.raw.startswith('{"codes"')
+        assert result.specialists == (label,)
+
+
+class TestSpecialistRegistry:
+    """Test the integer specialist registry and mask aggregation."""
+
+    def test_ids_codes_and_aliases(self):
+        """Test that names, codes and aliases resolve to stable IDs."""
+        registry = MedReferral.registry
+
+        assert registry.names[registry.id("Cardiologist")] == "Cardiologist"
+        assert registry.id("card") == registry.id("Cardiologist")
+        assert registry.codes[registry.id("Dermatologist")] == "DERM"
+        assert set(registry.ids("OB/GYN")) == {registry.id("Obstetrician"), registry.id("Gynecologist")}
+        assert frozenset(registry.names) == MedReferral.medical_specialists
+        with pytest.raises(KeyError):
+            registry.id("heart specialist")
+
+    def test_encode_decode_round_trip(self):
+        """Test that masks round-trip in ID order and reject unknown input."""
+        registry = MedReferral.registry
+        mask = registry.encode(["Urologist", "ALG", "ob/gyn"])
+
+        assert mask < 1 << 64
+        assert registry.decode(mask) == ("Allergist", "Gynecologist", "Obstetrician", "Urologist")
+        assert Recommendation(("Urologist",)).mask == 1 << registry.id("Urologist")
+        with pytest.raises(KeyError):
+            registry.encode(["Psychologist"])
+        with pytest.raises(ValueError):
+            registry.decode(1 << len(registry))
+
+    def test_counts_and_co_referrals(self):
+        """Test vectorized counts and co-referral matrices across chunk boundaries."""
+        import numpy as np
+
+        registry = MedReferral.registry
+        results = [("Cardiologist",), ("Cardiologist", "Pulmonologist"), (), ("Urologist",)] * 3
+        masks = registry.masks(results)
+        card, pulm, uro = (registry.id(name) for name in ("Cardiologist", "Pulmonologist", "Urologist"))
+
+        assert masks.dtype == np.uint64
+        counts = registry.counts(masks, chunk_size=5)
+        assert counts[card] == 6 and counts[pulm] == 3 and counts[uro] == 3 and counts.sum() == 12
+        matrix = registry.co_referrals(masks, chunk_size=5)
+        assert matrix[card, pulm] == matrix[pulm, card] == 3
+        assert matrix[card, uro] == 0
+        assert (np.diag(matrix) == counts).all()
+
+
+class TestCassetteBackend:
+    """Test recording and replaying completions."""
+
+    @patch('litellm.completion')
+    def test_record_then_replay_offline(self, mock_completion, tmp_path):
+        """Test that recorded answers replay with their usage and without calling the provider."""
+        mock_completion.return_value = _mock_response("Specialists: Cardiologist")
+        path = str(tmp_path / "answers.cassette")
+        recorder = CassetteBackend(path, mode="record")
+        recorded = MedReferral(backend=recorder).recommend("My chest hurts")
+        recorder.close()
+
+        mock_completion.reset_mock()
+        player = CassetteBackend(path)
+        result = MedReferral(backend=player).recommend("My chest hurts")
+
+        assert result.specialists == ("Cardiologist",)
+        assert result.prompt_tokens == recorded.prompt_tokens
+        mock_completion.assert_not_called()
+        assert player.stats()["hits"] == 1
+
+    def test_replay_miss_is_an_error(self, tmp_path):
+        """Test that an unrecorded request fails instead of reaching the network."""
+        path = tmp_path / "empty.cassette"
+        path.write_text("")
+
+        result = MedReferral(backend=CassetteBackend(str(path))).recommend("My chest hurts")
+
+        assert result.status is RecommendationStatus.ERROR
+        assert "not on the cassette" in result.error
+        with pytest.raises(CassetteMissError):
+            CassetteBackend(str(path)).completion(model="m", messages=[])
+        with pytest.raises(FileNotFoundError):
+            CassetteBackend(str(tmp_path / "missing.cassette"))
+
+    def test_auto_mode_records_misses_and_ignores_transport_options(self, tmp_path):
+        """Test that auto mode records once and that keys, timeouts and streaming share an entry."""
+        inner = Mock()
+        inner.completion.return_value = _mock_response("Specialists: Neurologist")
+        cassette = CassetteBackend(str(tmp_path / "auto.cassette"), mode="auto", backend=inner)
+        request = {"model": "m", "messages": [{"role": "user", "content": "q"}]}
+
+        cassette.completion(**request, api_key="a")
+        cassette.completion(**request, timeout=5)
+        chunks = list(cassette.completion(**request, stream=True))
+
+        inner.completion.assert_called_once()
+        assert chunks[0].choices[0].delta.content == "Specialists: Neurologist"
+        assert CassetteBackend.request_key(request) != CassetteBackend.request_key(dict(request, model="n"))
+
+    def test_later_recordings_win_and_torn_lines_are_skipped(self, tmp_path):
+        """Test that appends shadow earlier answers and an interrupted write is ignored."""
+        path = str(tmp_path / "append.cassette")
+        request = {"model": "m", "messages": [{"role": "user", "content": "q"}]}
+        for answer in ("Specialists: Urologist", "Specialists: Dermatologist"):
+            inner = Mock()
+            inner.completion.return_value = _mock_response(answer)
+            CassetteBackend(path, mode="record", backend=inner).completion(**request)
+        with open(path, "a") as f:
+            f.write("deadbeef\t{\"content\": ")
+
+        response = CassetteBackend(path).completion(**request)
+
+        assert response.choices[0].message.content == "Specialists: Dermatologist"
+
+    def test_async_replay(self, tmp_path):
+        """Test that async and streaming requests replay from the same cassette."""
+        from bench import FakeBackend, load_examples
+
+        question, label = load_examples()[0]
+        path = str(tmp_path / "async.cassette")
+        recorder = CassetteBackend(path, mode="record", backend=FakeBackend())
+        asyncio.run(AsyncMedReferral(backend=recorder).recommend(question))
+        recorder.close()
+
+        result = asyncio.run(AsyncMedReferral(backend=CassetteBackend(path), stream=True).recommend(question))
+
+        assert result.specialists == (label,)
+
+
+class TestThreadSafety:
+    """Test sharing one MedReferral across threads and the submit pool."""
+
+    def test_shared_instance_across_threads(self):
+        """Test that concurrent callers get correct answers and exact cache counters."""
+        from bench import FakeBackend, load_examples
+
+        examples = load_examples()[:20]
+        cache = LRUCache()
+        metrics = Metrics()
+        referral = MedReferral(backend=FakeBackend(), cache=cache, metrics=metrics)
+        errors = []
+
+        def worker():
+            for question, label in examples:
+                if referral.recommend(question).specialists != (label,):
+                    errors.append(question)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert cache.hits + cache.misses == 8 * len(examples)
+        assert metrics.snapshot()["recommendations"] == 8 * len(examples)
+
+    def test_submit_returns_futures(self):
+        """Test that submit runs recommendations on the worker pool."""
+        from bench import FakeBackend, load_examples
+
+        question, label = load_examples()[0]
+        referral = MedReferral(backend=FakeBackend(), max_workers=2)
+
+        futures = [referral.submit(question) for _ in range(5)]
+
+        assert [future.result(5).specialists for future in futures] == [(label,)] * 5
+        referral.close()
+
+    def test_submit_applies_backpressure(self):
+        """Test that submit blocks and then raises once workers and queue are full."""
+        import queue
+
+        release = threading.Event()
+        backend = Mock()
+        backend.completion.side_effect = lambda **kwargs: release.wait(5) and _mock_response("Specialists: Urologist")
+        referral = MedReferral(backend=backend, max_workers=1, max_pending=1)
+
+        first = referral.submit("q1")
+        second = referral.submit("q2")
+        with pytest.raises(queue.Full):
+            referral.submit("q3", timeout=0.05)
+        assert referral.rejected == 1
+
+        release.set()
+        assert first.result(5).specialists == ("Urologist",)
+        assert second.result(5).specialists == ("Urologist",)
+        assert referral.submit("q4", timeout=1).result(5).specialists == ("Urologist",)
+        referral.close()
+
+    def test_async_referral_has_no_submit(self):
+        """Test that the asyncio variant points callers at tasks instead."""
+        with pytest.raises(TypeError, match="create_task"):
+            AsyncMedReferral().submit("q")
+
+
+class _Throttled(Exception):
+    status_code = 429
+
+
+class _CappedBackend:
+    """A stand-in provider that answers 429 once more than ``cap`` calls are in flight."""
+
+    def __init__(self, cap, latency=0.005):
+        self.cap = cap
+        self.latency = latency
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            return self.active > self.cap
+
+    def _exit(self):
+        with self._lock:
+            self.active -= 1
+
+    def completion(self, **kwargs):
+        over = self._enter()
+        try:
+            time.sleep(self.latency)
+            if over:
+                raise _Throttled("429 Too Many Requests")
+            return _mock_response("Specialists: Dermatologist")
+        finally:
+            self._exit()
+
+    async def acompletion(self, **kwargs):
+        over = self._enter()
+        try:
+            await asyncio.sleep(self.latency)
+            if over:
+                raise _Throttled("429 Too Many Requests")
+            return _mock_response("Specialists: Dermatologist")
+        finally:
+            self._exit()
+
+
+class TestAdaptiveConcurrency:
+    """Test the AIMD concurrency limiter."""
+
+    def test_additive_increase_and_multiplicative_decrease(self):
+        """Test that successes grow the limit by about one per window and a 429 halves it."""
+        metrics = Metrics()
+        limiter = AdaptiveConcurrency(initial=4, max_limit=8, metrics=metrics)
+        for _ in range(4):
+            limiter.acquire()
+
+        for _ in range(5):
+            limiter.release(0.01)
+            limiter.acquire()
+        assert limiter.limit == 5
+
+        limiter.release(0.01, _Throttled())
+        assert limiter.limit == 2
+        assert limiter.stats()["throttled"] == 1
+        assert metrics.snapshot()["gauges"]["concurrency_limit"] == 2
+        assert "medrefer_concurrency_limit 2" in metrics.prometheus()
+
+    def test_unsaturated_calls_do_not_raise_the_limit(self):
+        """Test that the limit only grows when callers actually reach it."""
+        limiter = AdaptiveConcurrency(initial=4, max_limit=64)
+
+        for _ in range(100):
+            limiter.acquire()
+            limiter.release(0.01)
+
+        assert limiter.limit == 4
+        assert limiter.increases == 0
+
+    def test_decreases_once_per_window_and_ignores_bad_requests(self):
+        """Test that a burst of failures counts once and non-retryable errors are neutral."""
+        limiter = AdaptiveConcurrency(initial=8, max_limit=8)
+        limiter.acquire()
+        limiter.release(10.0)
+
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0.01, _Throttled())
+        assert limiter.limit == 4
+
+        bad_request = ValueError("bad request")
+        limiter.acquire()
+        limiter.release(0.01, bad_request)
+        assert limiter.limit == 4
+
+    def test_sustained_slow_responses_reduce_the_limit(self):
+        """Test that a median latency far above the baseline counts as congestion."""
+        limiter = AdaptiveConcurrency(initial=8, max_limit=8, latency_tolerance=2.0, latency_window=20)
+        for latency in [0.01] * 19 + [1.0]:
+            limiter.acquire()
+            limiter.release(latency)
+        assert limiter.limit == 8
+
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(1.0)
+        assert limiter.limit == 4
+
+    def test_batch_respects_explicit_max_concurrency(self):
+        """Test that a limiter lowers but never raises the batch's max_concurrency."""
+        referral = MedReferral(concurrency=AdaptiveConcurrency(initial=4, max_limit=16))
+
+        assert referral._batch_concurrency(8) == 8
+        assert referral._batch_concurrency(32) == 16
+
+    def test_retried_throttling_reaches_the_limiter(self):
+        """Test that 429s retried inside ResilientBackend still lower the limit."""
+        backend = Mock()
+        backend.completion.side_effect = [_Throttled("429"), _Throttled("429"),
+                                          _mock_response("Specialists: Dermatologist")]
+        limiter = AdaptiveConcurrency(initial=8, max_limit=8)
+        resilient = ResilientBackend(backend, retry=RetryPolicy(base_delay=0), concurrency=limiter)
+        referral = MedReferral(backend=resilient, concurrency=limiter)
+        # A one-second baseline makes both 429s one congestion event
+        limiter.acquire()
+        limiter.release(1.0)
+
+        assert str(referral.recommend("itchy rash")) == "Dermatologist"
+        assert limiter.stats()["throttled"] == 2
+        assert limiter.limit == 4
+        assert limiter.stats()["in_flight"] == 0
+
+    def test_acquire_blocks_at_the_limit(self):
+        """Test that callers past the limit wait for a slot."""
+        limiter = AdaptiveConcurrency(initial=1, max_limit=1)
+        limiter.acquire()
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        waiter.start()
+
+        assert not acquired.wait(0.05)
+        limiter.release(0.01)
+        assert acquired.wait(5)
+        waiter.join()
+
+    def test_threaded_batch_converges_below_provider_capacity(self):
+        """Test that the threaded batch path backs off from 429s."""
+        backend = _CappedBackend(cap=3)
+        limiter = AdaptiveConcurrency(initial=8, max_limit=16)
+        referral = MedReferral(backend=backend, concurrency=limiter)
+
+        results = referral.recommend_many(["itchy rash"] * 200)
+
+        assert limiter.decreases > 0
+        assert limiter.limit <= 6
+        assert backend.peak <= 16
+        assert sum(result.status is RecommendationStatus.OK for result in results) > 100
+
+    def test_async_batch_converges_below_provider_capacity(self):
+        """Test that the asyncio batch path shares the same limiter behavior."""
+        backend = _CappedBackend(cap=3)
+        limiter = AdaptiveConcurrency(initial=8, max_limit=16)
+        referral = AsyncMedReferral(backend=backend, concurrency=limiter)
+
+        results = asyncio.run(referral.recommend_many(["itchy rash"] * 200))
+
+        assert limiter.decreases > 0
+        assert limiter.limit <= 6
+        assert limiter.stats()["in_flight"] == 0
+        assert sum(result.status is RecommendationStatus.OK for result in results) > 100